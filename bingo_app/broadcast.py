@@ -0,0 +1,46 @@
+"""
+Eventos de grupo serializados una sola vez.
+
+group_event() construye el mensaje final que recibirá el navegador y lo deja
+ya convertido a JSON en 'text'. Los handlers de BingoConsumer lo reenvían tal
+cual, así que el coste de serializar no se multiplica por el número de
+sockets del grupo.
+
+Los clientes que negocian el subprotocolo BINARY_SUBPROTOCOL reciben
+number_called como una trama binaria de 4 bytes ('bytes' en el evento):
+tipo de trama (1 byte), seq (2 bytes, big endian) y número (1 byte). El
+resto de eventos se envían como JSON en cualquier caso.
+"""
+import json
+import struct
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+BINARY_SUBPROTOCOL = 'bingo.bin.v1'
+FRAME_NUMBER_CALLED = 1
+NUMBER_CALLED_FRAME = struct.Struct('!BHB')
+
+
+def group_event(event_type, **payload):
+    """Evento para group_send con el mensaje del cliente ya serializado"""
+    return {'type': event_type, 'text': json.dumps({'type': event_type, **payload})}
+
+
+def number_called_event(number, seq):
+    """number_called en JSON y en trama binaria para el subprotocolo compacto"""
+    event = group_event('number_called', number=number, seq=seq)
+    event['bytes'] = NUMBER_CALLED_FRAME.pack(FRAME_NUMBER_CALLED, seq, number)
+    # Para fusionar varios number_called pendientes de un cliente lento (outbox.py)
+    event['number'] = number
+    event['seq'] = seq
+    return event
+
+
+async def group_send(group, event_type, **payload):
+    await get_channel_layer().group_send(group, group_event(event_type, **payload))
+
+
+def group_send_sync(group, event_type, **payload):
+    async_to_sync(group_send)(group, event_type, **payload)
@@ -0,0 +1,111 @@
+"""
+Chat de las salas de juego agrupado por lotes.
+
+Los mensajes que llegan a los consumers de un proceso se acumulan por
+partida y, pasados BINGO_CHAT_BATCH_INTERVAL segundos desde el primero, se
+guardan con un solo bulk_create y se difunden en un único evento chat_batch.
+Así una ráfaga de chat cuesta una inserción y un group_send por lote, no por
+línea, y no compite con los number_called en el bucle de eventos.
+
+Cada usuario tiene además un cubo de tokens por partida (BINGO_CHAT_RATE
+mensajes por segundo con ráfagas de hasta BINGO_CHAT_BURST). Los cubos son
+locales al proceso.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .broadcast import group_send
+from .models import ChatMessage
+
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 500
+MAX_BUCKETS = 100000
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class ChatBatcher:
+    """Acumula los mensajes de chat de este proceso y los envía por lotes"""
+
+    def __init__(self, interval=None, rate=None, burst=None):
+        if interval is None:
+            interval = getattr(settings, 'BINGO_CHAT_BATCH_INTERVAL', 0.1)
+        if rate is None:
+            rate = getattr(settings, 'BINGO_CHAT_RATE', 1.0)
+        if burst is None:
+            burst = getattr(settings, 'BINGO_CHAT_BURST', 5)
+        self.interval = interval
+        self.rate = rate
+        self.burst = burst
+        self.pending = {}
+        self.buckets = {}
+        self.tasks = set()
+
+    def allow(self, game_id, user_id):
+        key = (game_id, user_id)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self.buckets.clear()
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket.consume()
+
+    def add(self, game_id, user, message):
+        """Encola un mensaje; devuelve False si el usuario superó su límite"""
+        if not self.allow(game_id, user.id):
+            return False
+        batch = self.pending.get(game_id)
+        if batch is None:
+            batch = self.pending[game_id] = []
+            task = asyncio.ensure_future(self._flush_later(game_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        batch.append((user, message[:MAX_MESSAGE_LENGTH], datetime.now().isoformat()))
+        return True
+
+    async def _flush_later(self, game_id):
+        await asyncio.sleep(self.interval)
+        await self.flush(game_id)
+
+    async def flush(self, game_id):
+        batch = self.pending.pop(game_id, None)
+        if not batch:
+            return
+        try:
+            await database_sync_to_async(ChatMessage.objects.bulk_create)([
+                ChatMessage(game_id=game_id, user_id=user.id, message=message)
+                for user, message, _ in batch
+            ])
+        except Exception:
+            logger.exception("Error guardando %s mensajes de chat de la partida %s", len(batch), game_id)
+        await group_send(f'game_{game_id}', 'chat_batch', messages=[
+            {'user': user.username, 'message': message, 'timestamp': timestamp}
+            for user, message, timestamp in batch
+        ])
+
+
+chat_batcher = ChatBatcher()
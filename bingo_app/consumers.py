@@ -1,261 +1,169 @@
-from decimal import Decimal
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import AnonymousUser
 import asyncio
-from datetime import datetime
-from .models import Game, Player, ChatMessage, Transaction, Message, User
+from urllib.parse import parse_qs
+from .models import Game, Transaction, Message, User
+from . import event_log
+from .broadcast import BINARY_SUBPROTOCOL, group_send
+from .chat import chat_batcher
+from .outbox import RESYNC_CLOSE_CODE, Outbox, merged_numbers
+from .scheduler import notify_scheduler
+from .snapshots import get_snapshot
 from django.db.models import Sum
 
 
 class BingoConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.auto_call_task = None
-        self.game = None
         self.game_id = None
         self.game_group_name = None
+        self.user_group_name = None
         self.user = None
+        self.is_organizer = False
+        self.binary = False
+        self.outbox = Outbox()
+        self.writer = None
 
     async def connect(self):
         self.user = self.scope.get('user', AnonymousUser())
-        self.game_id = self.scope['url_route']['kwargs']['game_id']
+        self.game_id = int(self.scope['url_route']['kwargs']['game_id'])
         self.game_group_name = f'game_{self.game_id}'
-        
+
         if isinstance(self.user, AnonymousUser):
             await self.close()
             return
+        # Eventos de la partida que solo interesan a este usuario
+        self.user_group_name = f'game_{self.game_id}_user_{self.user.id}'
         
-        self.game = await self.get_game()
-        if not self.game:
+        snapshot = await self.get_snapshot()
+        if snapshot is None:
             await self.close()
             return
-            
+        # Se calcula una vez: los permisos no vuelven a consultar la base de datos
+        self.is_organizer = snapshot.organizer_id == self.user.id
+
         await self.channel_layer.group_add(
             self.game_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        # Subprotocolo binario opcional; sin él todo va en JSON
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', ())
+        await self.accept(subprotocol=BINARY_SUBPROTOCOL if self.binary else None)
+        self.writer = asyncio.ensure_future(self.write_outbox())
 
-        # Enviar estado actual del juego al conectar
-        await self.send_game_status()
+        # Enviar estado actual del juego al conectar (o solo lo perdido si el cliente reanuda)
+        await self.send_game_status(snapshot, self.last_seq_from_query())
 
-    async def send_game_status(self):
-        """Envía el estado actual del juego al cliente"""
-        game_data = await self.get_game_data()
+    def last_seq_from_query(self):
+        values = parse_qs(self.scope.get('query_string', b'').decode()).get('last_seq')
+        try:
+            return int(values[0]) if values else None
+        except ValueError:
+            return None
 
-        await self.send(text_data=json.dumps({
-            'type': 'game_status',
-            'is_started': game_data['is_started'],
-            'is_finished': game_data['is_finished'],
-            'is_auto_calling': game_data['is_auto_calling'],
-            'current_number': game_data['current_number'],
-            'called_numbers': game_data['called_numbers'],
-            'current_prize': float(game_data['current_prize']) if isinstance(game_data['current_prize'], Decimal) else game_data['current_prize'],
-            'total_cards_sold': game_data['total_cards_sold'],
-            'next_prize_target': game_data['next_prize_target'],
-            'progress_percentage': game_data['progress_percentage']
-        }))
+    async def send_game_status(self, snapshot=None, last_seq=None):
+        """
+        Envía el estado actual del juego (instantánea compartida, ya serializada).
+        Si el cliente indica el último seq que aplicó y los eventos siguientes
+        siguen en event_log, envía solo esos eventos y el estado sin called_numbers.
+        """
+        if snapshot is None:
+            snapshot = await self.get_snapshot()
+        if snapshot is None:
+            return
+        if isinstance(last_seq, int):
+            events = await sync_to_async(event_log.missed_events)(self.game_id, last_seq, snapshot.seq)
+            if events is not None:
+                await self.queue('resume', {'text': snapshot.resume_text})
+                for text in events:
+                    await self.queue('resume', {'text': text})
+                return
+        await self.queue('game_status', {'text': snapshot.text})
+
+    async def queue(self, event_type, event):
+        """Encola un mensaje para el cliente; si la cola se desborda, lo desconecta"""
+        if self.writer is None:
+            return
+        if not self.outbox.push(event_type, event):
+            # Cliente sin remedio: al reconectar reanudará desde su último seq
+            self.outbox.clear()
+            self.writer.cancel()
+            self.writer = None
+            await self.close(code=RESYNC_CLOSE_CODE)
+
+    async def write_outbox(self):
+        """Única tarea que escribe en el socket los mensajes de la cola"""
+        while True:
+            event_type, events = await self.outbox.pop()
+            if event_type == 'number_called' and len(events) > 1:
+                text, data = merged_numbers(events, self.binary)
+            elif self.binary and 'bytes' in events[0]:
+                text, data = None, events[0]['bytes']
+            else:
+                text, data = events[0]['text'], None
+            await self.send(text_data=text, bytes_data=data)
 
     @database_sync_to_async
-    def get_game_data(self):
-        if not self.game:
-            return None
-            
-        self.game.refresh_from_db()
-        return {
-            'is_started': self.game.is_started,
-            'is_finished': self.game.is_finished,
-            'is_auto_calling': self.game.is_auto_calling,
-            'current_number': self.game.current_number,
-            'called_numbers': self.game.called_numbers,
-            'current_prize': self.game.current_prize,
-            'total_cards_sold': self.game.total_cards_sold,
-            'next_prize_target': self.game.next_prize_target,
-            'progress_percentage': self.game.progress_percentage
-        }
+    def get_snapshot(self):
+        return get_snapshot(self.game_id)
 
     async def disconnect(self, close_code):
-        if self.auto_call_task and not self.auto_call_task.done():
-            self.auto_call_task.cancel()
-            try:
-                await self.auto_call_task
-            except asyncio.CancelledError:
-                pass
-        
-        if hasattr(self, 'game_group_name'):
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+        if self.game_group_name:
             await self.channel_layer.group_discard(
                 self.game_group_name,
                 self.channel_name
             )
-
-    @database_sync_to_async
-    def get_game(self):
-        try:
-            return Game.objects.get(id=self.game_id)
-        except Game.DoesNotExist:
-            return None
+        if self.user_group_name:
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
 
     @database_sync_to_async
     def start_game(self):
-        if not self.game or self.game.is_started or self.game.is_finished:
+        """Inicia la partida y su llamada automática; Game.start_game emite game_started"""
+        game = Game.objects.filter(id=self.game_id).first()
+        if not game or not game.start_game():
             return False
-            
-        self.game.is_started = True
-        self.game.save()
+        game.start_auto_calling()
         return True
 
-    @database_sync_to_async
-    def call_next_number(self):
-        if not self.game:
-            return None
-        return self.game.call_number()
-
-    @database_sync_to_async
-    def get_current_numbers(self):
-        if not self.game:
-            return []
-        return self.game.called_numbers
-
-    @database_sync_to_async
-    def check_all_players_for_bingo(self):
-        if not self.game:
-            return None
-            
-        players = Player.objects.filter(game=self.game).select_related('user')
-        for player in players:
-            if player.check_bingo():
-                return player
-        return None
-
-    @database_sync_to_async
-    def process_winner(self, player):
-        if not self.game or not player:
-            return 0.0
-            
-        self.game.refresh_from_db()
-        prize = float(self.game.current_prize) if self.game.current_prize else 0.0
-        
-        self.game.end_game()
-        return prize
-
     @database_sync_to_async
     def toggle_auto_call_mode(self):
-        if not self.game:
+        game = Game.objects.filter(id=self.game_id).first()
+        if not game:
             return False
-            
-        if self.game.is_auto_calling:
-            self.game.stop_auto_calling()
+
+        if game.is_auto_calling:
+            game.stop_auto_calling()
             return False
         else:
-            self.game.start_auto_calling()
+            game.start_auto_calling()
             return True
 
-    async def start_auto_call_task(self):
-        """Inicia la tarea de llamada automática"""
-        if self.auto_call_task and not self.auto_call_task.done():
-            self.auto_call_task.cancel()
-        
-        self.auto_call_task = asyncio.create_task(self.auto_call_numbers())
-
-    async def auto_call_numbers(self):
-        """Tarea asíncrona para llamada automática de números"""
-        while await self.is_auto_calling_active():
-            try:
-                number = await self.call_next_number()
-                if not number:
-                    await asyncio.sleep(1)
-                    continue
-
-                called_numbers = await self.get_current_numbers()
-                
-
-                await self.notify_number_called(number, called_numbers)
-
-                winner = await self.check_all_players_for_bingo()
-
-                if winner:
-                    prize = await self.process_winner(winner)
-                    await self.notify_game_ended(winner.user.username, prize, called_numbers)
-                    break
-
-                
-                await asyncio.sleep(self.game.auto_call_interval)
-                
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                print(f"Error en auto_call_numbers: {str(e)}")
-                break
-
-    @database_sync_to_async
-    def is_auto_calling_active(self):
-        if not self.game:
-            return False
-        return self.game.is_auto_calling and self.game.is_started and not self.game.is_finished
-
-    async def notify_number_called(self, number, called_numbers):
-        await self.channel_layer.group_send(
-            self.game_group_name,
-            {
-                'type': 'number_called',
-                'number': number,
-                'called_numbers': called_numbers
-            }
-        )
-
-    async def notify_game_ended(self, winner, prize, called_numbers):
-        await self.channel_layer.group_send(
-            self.game_group_name,
-            {
-                'type': 'game_ended',
-                'winner': winner,
-                'prize': float(prize) if isinstance(prize, Decimal) else prize,
-                'called_numbers': called_numbers
-            }
-        )
-
-    async def notify_game_started(self):
-        await self.channel_layer.group_send(
-            self.game_group_name,
-            {
-                'type': 'game_started',
-                'is_started': True,
-                'is_auto_calling': self.game.is_auto_calling
-            }
-        )
-
     async def receive(self, text_data):
         try:
             data = json.loads(text_data)
             
             if data['type'] == 'start_game':
-                if await database_sync_to_async(lambda: self.user == self.game.organizer)():
+                if self.is_organizer:
                     if await self.start_game():
-                        await self.notify_game_started()
-                        await database_sync_to_async(self.game.start_auto_calling)()
-                        await self.start_auto_call_task()
-                        await self.channel_layer.group_send(
-                            self.game_group_name,
-                            {
-                                'type': 'auto_call_toggled',
-                                'is_auto_calling': True
-                            }
-                        )
+                        await notify_scheduler(self.game_id)
+                        await group_send(self.game_group_name, 'auto_call_toggled', is_auto_calling=True)
 
             elif data['type'] == 'toggle_auto_call':
-                if await database_sync_to_async(lambda: self.user == self.game.organizer)():
+                if self.is_organizer:
                     is_auto_calling = await self.toggle_auto_call_mode()
-                    await self.channel_layer.group_send(
-                        self.game_group_name,
-                        {
-                            'type': 'auto_call_toggled',
-                            'is_auto_calling': is_auto_calling
-                        }
-                    )
-                    if is_auto_calling:
-                        await self.start_auto_call_task()
+                    await group_send(self.game_group_name, 'auto_call_toggled', is_auto_calling=is_auto_calling)
+                    await notify_scheduler(self.game_id)
+
+            elif data['type'] == 'resync':
+                # El cliente detectó un hueco en los seq: reenviar lo que le falta
+                await self.send_game_status(last_seq=data.get('last_seq'))
 
             elif data['type'] == 'chat_message':
                 message = data.get('message', '').strip()
@@ -271,89 +179,27 @@ class BingoConsumer(AsyncWebsocketConsumer):
             print(f"Error in receive: {str(e)}")
 
     async def handle_chat_message(self, message):
-        await database_sync_to_async(ChatMessage.objects.create)(
-            game=self.game,
-            user=self.user,
-            message=message
-        )
-        
-        await self.channel_layer.group_send(
-            self.game_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'user': self.user.username,
-                'timestamp': datetime.now().isoformat()
-            }
-        )
+        # Se guarda y difunde por lotes (chat.py), con límite por usuario
+        if not chat_batcher.add(self.game_id, self.user, message):
+            await self.queue('chat_rate_limited', {'text': json.dumps({
+                'type': 'chat_rate_limited',
+                'message': 'Estás enviando mensajes demasiado rápido'
+            })})
 
     # Handlers para mensajes recibidos del grupo
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'user': event['user'],
-            'timestamp': event['timestamp']
-        }))
-
-    async def number_called(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'number_called',
-            'number': event['number'],
-            'called_numbers': event['called_numbers']
-        }))
-
-    async def game_ended(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'game_ended',
-            'winner': event['winner'],
-            'prize': event['prize'],
-            'called_numbers': event['called_numbers']
-        }))
-
-    async def auto_call_toggled(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'auto_call_toggled',
-            'is_auto_calling': event['is_auto_calling']
-        }))
-
-    async def game_started(self, event):
-        game = await self.get_game()
-        await self.send(text_data=json.dumps({
-            'type': 'game_started',
-            'is_started': event['is_started'],
-            'total_cards_sold': game.total_cards_sold,  # Añade esto
-             'max_cards_sold': game.max_cards_sold,  # Asegúrate de enviar esto
-
-        }))
-
-    async def game_status(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def prize_updated(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'prize_updated',
-            'new_prize': event['new_prize'],
-            'increase_amount': event['increase_amount'],
-            'total_cards': event['total_cards'],
-            'next_target': event['next_target'],
-            'progress_percentage': event.get('progress_percentage', 0)
-        }))
-
-    async def card_purchased(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'card_purchased',
-            'user': event['user'],
-            'new_balance': event['new_balance'],
-            'player_cards_count': event['player_cards_count'],
-             'new_card': event['new_card'],
-            'prize_increased': event['prize_increased'],
-            'new_prize': event['new_prize'],
-            'increase_amount': event['increase_amount'],
-            'total_cards_sold': event['total_cards_sold'],
-            'next_prize_target': event['next_prize_target'],
-            'progress_percentage': event.get('progress_percentage', 0)
-        }))
+    async def forward_event(self, event):
+        """Encola sin tocarlo el mensaje serializado una vez por broadcast.group_event"""
+        await self.queue(event['type'], event)
+
+    chat_batch = forward_event
+    number_called = forward_event
+    game_ended = forward_event
+    stage_won = forward_event
+    auto_call_toggled = forward_event
+    prize_updated = forward_event
+    card_purchased = forward_event
+    own_card_purchased = forward_event
+    game_started = forward_event
 
 
 class MessageConsumer(AsyncWebsocketConsumer):
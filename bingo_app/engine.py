@@ -0,0 +1,366 @@
+"""
+Motor de verificación de bingo basado en máscaras de bits.
+
+Cada cartón 5x5 se compila una sola vez a un diccionario número -> bit (25 bits,
+casilla (i, j) = bit i*5 + j) más una máscara con las casillas libres (0).
+Cada patrón ganador se compila a una tupla de máscaras; un cartón gana cuando
+alguna de esas máscaras está contenida en sus casillas marcadas.
+"""
+from array import array
+from functools import lru_cache
+import random
+import secrets
+import threading
+
+import numpy as np
+
+
+FREE_CELL = 0
+FULL_CARD_MASK = (1 << 25) - 1
+MAX_BALL = 75
+
+
+def new_draw_seed():
+    return secrets.randbits(63)
+
+
+@lru_cache(maxsize=1024)
+def draw_order(seed):
+    """Permutación completa de bolas 1..75 derivada de la semilla (reproducible)"""
+    return tuple(random.Random(seed).sample(range(1, MAX_BALL + 1), MAX_BALL))
+
+
+def next_in_draw(seed, cursor, called_mask):
+    """
+    Siguiente número del orden de la semilla a partir de `cursor` que no esté
+    en called_mask. Devuelve (número o None, nuevo cursor).
+    """
+    order = draw_order(seed)
+    while cursor < len(order):
+        candidate = order[cursor]
+        cursor += 1
+        if not called_mask >> candidate & 1:
+            return candidate, cursor
+    return None, cursor
+
+
+def cell_bit(row, col):
+    return 1 << (row * 5 + col)
+
+
+def encode_card(card):
+    """Codifica un cartón 5x5 en 25 bytes, fila por fila (0 = casilla libre)"""
+    return bytes(num for row in card for num in row)
+
+
+def decode_card(data):
+    data = bytes(data)
+    return [list(data[i:i + 5]) for i in range(0, 25, 5)]
+
+
+def random_cards_numpy(count, rng=None):
+    """
+    Genera `count` cartones B-I-N-G-O aleatorios de forma vectorizada.
+    Devuelve un array uint8 (count, 5, 5) con 0 en la casilla central.
+    """
+    rng = rng or np.random.default_rng()
+    # Para cada columna, los 5 primeros de una permutación aleatoria de sus 15 números
+    picks = np.argsort(rng.random((count, 5, 15)), axis=2)[:, :, :5].astype(np.uint8)
+    picks += (np.arange(5, dtype=np.uint8) * 15 + 1)[None, :, None]
+    cards = picks.transpose(0, 2, 1).copy()  # columnas -> filas
+    cards[:, 2, 2] = FREE_CELL
+    return cards
+
+
+def generate_unique_cards(count, exclude=(), rng=None):
+    """Genera `count` cartones codificados distintos entre sí y de los de `exclude`"""
+    seen = set(bytes(data) for data in exclude)
+    result = []
+    while len(result) < count:
+        missing = count - len(result)
+        for row in random_cards_numpy(missing + missing // 10 + 1, rng).reshape(-1, 25):
+            data = row.tobytes()
+            if data not in seen:
+                seen.add(data)
+                result.append(data)
+                if len(result) == count:
+                    break
+    return result
+
+
+def compile_packed_card(data):
+    """Compila un cartón codificado a (pares número -> bits, máscara de casillas libres)"""
+    cells = {}
+    free_mask = 0
+    for position, num in enumerate(bytes(data)):
+        bit = 1 << position
+        if num == FREE_CELL:
+            free_mask |= bit
+        else:
+            # Los cartones antiguos (Player.generate_card) pueden repetir números
+            cells[num] = cells.get(num, 0) | bit
+    return tuple(cells.items()), free_mask
+
+
+def compile_card(card):
+    return compile_packed_card(encode_card(card))
+
+
+def numbers_mask(numbers):
+    """Convierte una colección de números llamados en un entero con el bit n activo"""
+    mask = 0
+    for num in numbers:
+        mask |= 1 << num
+    return mask
+
+
+def marked_mask(compiled_card, called_mask):
+    """Máscara de casillas marcadas de un cartón compilado"""
+    cells, marked = compiled_card
+    for num, bits in cells:
+        if called_mask >> num & 1:
+            marked |= bits
+    return marked
+
+
+def is_winning_mask(marked, pattern_masks):
+    for mask in pattern_masks:
+        if marked & mask == mask:
+            return True
+    return False
+
+
+def _row_masks():
+    return tuple(sum(cell_bit(i, j) for j in range(5)) for i in range(5))
+
+
+def _column_masks():
+    return tuple(sum(cell_bit(i, j) for i in range(5)) for j in range(5))
+
+
+def _diagonal_masks():
+    return (
+        sum(cell_bit(i, i) for i in range(5)),
+        sum(cell_bit(i, 4 - i) for i in range(5)),
+    )
+
+
+@lru_cache(maxsize=256)
+def _compile_pattern(winning_pattern, custom_pattern):
+    if winning_pattern == 'HORIZONTAL':
+        return _row_masks()
+    if winning_pattern == 'VERTICAL':
+        return _column_masks()
+    if winning_pattern == 'DIAGONAL':
+        return _diagonal_masks()
+    if winning_pattern == 'FULL':
+        return (FULL_CARD_MASK,)
+    if winning_pattern == 'CORNERS':
+        return (cell_bit(0, 0) | cell_bit(0, 4) | cell_bit(4, 0) | cell_bit(4, 4),)
+    if winning_pattern == 'CUSTOM' and custom_pattern:
+        mask = 0
+        for i, row in enumerate(custom_pattern[:5]):
+            for j, value in enumerate(row[:5]):
+                if value == 1:
+                    mask |= cell_bit(i, j)
+        return (mask,)
+    # Patrón desconocido o personalizado sin matriz: nunca hay ganador
+    return ()
+
+
+def compile_pattern(winning_pattern, custom_pattern=None):
+    """Devuelve la tupla de máscaras para un patrón (cacheada)"""
+    if custom_pattern:
+        custom_pattern = tuple(tuple(row) for row in custom_pattern)
+    else:
+        custom_pattern = None
+    return _compile_pattern(winning_pattern, custom_pattern)
+
+
+def game_pattern_masks(game):
+    return compile_pattern(game.winning_pattern, game.custom_pattern)
+
+
+def count_matches(marked, pattern_masks):
+    return sum(1 for mask in pattern_masks if marked & mask == mask)
+
+
+def stage_reached(marked, stage):
+    """Una etapa es (máscaras, líneas requeridas): se cumple con `lines` máscaras completas"""
+    pattern_masks, lines = stage
+    if lines <= 1:
+        return is_winning_mask(marked, pattern_masks)
+    return count_matches(marked, pattern_masks) >= lines
+
+
+@lru_cache(maxsize=256)
+def _compile_stages(stage_keys, custom_pattern):
+    return tuple((_compile_pattern(pattern, custom_pattern), lines) for pattern, lines in stage_keys)
+
+
+def compile_stages(stage_definitions, custom_pattern=None):
+    """
+    Compila una lista de etapas [(patrón, líneas), ...] a una tupla de
+    (máscaras, líneas) cacheada. CUSTOM usa la matriz custom_pattern.
+    """
+    if custom_pattern:
+        custom_pattern = tuple(tuple(row) for row in custom_pattern)
+    else:
+        custom_pattern = None
+    stage_keys = tuple((pattern, max(1, int(lines))) for pattern, lines in stage_definitions)
+    return _compile_stages(stage_keys, custom_pattern)
+
+
+def game_stage_definitions(game):
+    """Etapas intermedias de prize_stages seguidas de la etapa final (winning_pattern)"""
+    definitions = [(stage['pattern'], stage.get('lines', 1)) for stage in game.prize_stages or []]
+    definitions.append((game.winning_pattern, 1))
+    return definitions
+
+
+def game_stages(game):
+    return compile_stages(game_stage_definitions(game), game.custom_pattern)
+
+
+class GameCardIndex:
+    """
+    Índice invertido número -> (cartón, bits de casilla) para una partida.
+
+    Mantiene la máscara de casillas marcadas de cada cartón y solo la actualiza
+    para los cartones que contienen el número llamado, de modo que detectar
+    ganadores cuesta O(cartones con ese número) por bola. Todas las etapas de
+    premio se evalúan en la misma pasada.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.by_number = {}
+        self.marked = array('I')
+        self.card_keys = []  # (player_id, card_id)
+        self.applied_mask = 0
+        self.winners = tuple(set() for _ in stages)
+        self.lock = threading.Lock()
+        self._evaluated = False
+
+    def __len__(self):
+        return len(self.card_keys)
+
+    def add_card(self, player_id, card_id, data):
+        """Añade un cartón codificado con encode_card"""
+        cells, free_mask = compile_packed_card(data)
+        slot = len(self.card_keys)
+        self.card_keys.append((player_id, card_id))
+        self.marked.append(free_mask)
+        for num, bits in cells:
+            entry = self.by_number.get(num)
+            if entry is None:
+                entry = self.by_number[num] = (array('I'), array('I'))
+            entry[0].append(slot)
+            entry[1].append(bits)
+
+    def _check_slot(self, slot, marked):
+        for stage, winners in zip(self.stages, self.winners):
+            if stage_reached(marked, stage):
+                winners.add(self.card_keys[slot][0])
+
+    def mark(self, number):
+        """Marca un número y evalúa solo los cartones que lo contienen"""
+        bit = 1 << number
+        if self.applied_mask & bit:
+            return
+        self.applied_mask |= bit
+        entry = self.by_number.get(number)
+        if entry is None:
+            return
+        marked = self.marked
+        for slot, bits in zip(*entry):
+            value = marked[slot] | bits
+            marked[slot] = value
+            if self._evaluated:
+                self._check_slot(slot, value)
+
+    def sync(self, called_numbers):
+        """Aplica los números aún no marcados y devuelve los player_id ganadores de cada etapa"""
+        with self.lock:
+            for number in called_numbers:
+                self.mark(number)
+            if not self._evaluated:
+                # Primera sincronización: evaluar todos los cartones una vez
+                for slot, value in enumerate(self.marked):
+                    self._check_slot(slot, value)
+                self._evaluated = True
+            return tuple(set(winners) for winners in self.winners)
+
+
+def marked_masks_numpy(cards, called_numbers):
+    """Máscara de 25 bits de casillas marcadas para cada cartón de un array (N, 5, 5)"""
+    count = len(cards)
+    if count == 0:
+        return np.zeros(0, dtype=np.uint32)
+
+    flat = cards.reshape(count, 25)
+    size = max(128, int(flat.max()) + 1, max(called_numbers, default=0) + 1)
+    called = np.zeros(size, dtype=bool)
+    called[FREE_CELL] = True
+    if called_numbers:
+        called[np.fromiter(called_numbers, dtype=np.int64)] = True
+
+    marked = called[flat].astype(np.uint32) << np.arange(25, dtype=np.uint32)
+    return np.bitwise_or.reduce(marked, axis=1)
+
+
+def stage_reached_numpy(marked, stage):
+    pattern_masks, lines = stage
+    if not pattern_masks:
+        return np.zeros(len(marked), dtype=bool)
+    masks = np.array(pattern_masks, dtype=np.uint32)
+    return ((marked[:, None] & masks) == masks).sum(axis=1) >= lines
+
+
+def evaluate_cards_numpy(cards, called_numbers, pattern_masks):
+    """
+    Evalúa todos los cartones de una vez.
+
+    cards: array entero (N, 5, 5). Devuelve un array booleano (N,) con True
+    para los cartones que cumplen alguna de las máscaras del patrón.
+    """
+    return stage_reached_numpy(marked_masks_numpy(cards, called_numbers), (pattern_masks, 1))
+
+
+class GameCardArray:
+    """
+    Cartones de una partida apilados en un array (N, 5, 5) para evaluar todas
+    las etapas de premio de todos los cartones en una sola pasada vectorizada.
+    Expone la misma interfaz sync() que GameCardIndex.
+    """
+    applied_mask = 0
+
+    def __init__(self, stages):
+        self.stages = stages
+        self._owners = []
+        self._chunks = []
+        self.owners = np.zeros(0, dtype=np.int64)
+        self.cards = np.zeros((0, 5, 5), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.owners)
+
+    def add_card(self, player_id, card_id, data):
+        """Añade un cartón codificado con encode_card"""
+        self._owners.append(player_id)
+        self._chunks.append(bytes(data))
+
+    def _stack(self):
+        if self._chunks:
+            packed = np.frombuffer(b''.join(self._chunks), dtype=np.uint8).reshape(-1, 5, 5)
+            self.owners = np.concatenate([self.owners, np.array(self._owners, dtype=np.int64)])
+            self.cards = np.concatenate([self.cards, packed])
+            self._owners, self._chunks = [], []
+
+    def sync(self, called_numbers):
+        self._stack()
+        marked = marked_masks_numpy(self.cards, list(called_numbers))
+        return tuple(
+            set(self.owners[stage_reached_numpy(marked, stage)].tolist())
+            for stage in self.stages
+        )
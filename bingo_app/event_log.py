@@ -0,0 +1,82 @@
+"""
+Últimos number_called de cada partida para reanudar conexiones.
+
+Cada number_called se guarda ya serializado con su seq en un buffer acotado
+(BINGO_EVENT_BUFFER_SIZE eventos por partida). Un cliente que se reconecta
+indica el último seq que aplicó y recibe solo los eventos que le faltan; si
+el hueco es más antiguo que el buffer, el consumer envía la instantánea
+completa.
+
+Con BINGO_REDIS_STATE el buffer es un sorted set por partida
+(bingo:{game:<id>}:events, puntuado por seq) compartido entre workers; sin
+Redis es un deque por partida en memoria del proceso.
+"""
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from . import redis_state
+
+
+_local = {}
+_lock = threading.Lock()
+
+
+def events_key(game_id):
+    return redis_state.game_key(game_id, 'events')
+
+
+def _size():
+    return getattr(settings, 'BINGO_EVENT_BUFFER_SIZE', 30)
+
+
+def record_many(events):
+    """Guarda [(game_id, seq, texto)] en los buffers de sus partidas"""
+    if not events:
+        return
+    size = _size()
+    if redis_state.enabled():
+        ttl = redis_state.state_ttl()
+        pipe = redis_state.get_redis().pipeline(transaction=False)
+        for game_id, seq, text in events:
+            key = events_key(game_id)
+            pipe.zadd(key, {text: seq})
+            pipe.zremrangebyrank(key, 0, -size - 1)
+            pipe.expire(key, ttl)
+        pipe.execute()
+    else:
+        with _lock:
+            for game_id, seq, text in events:
+                buffer = _local.get(game_id)
+                if buffer is None:
+                    buffer = _local[game_id] = deque(maxlen=size)
+                buffer.append((seq, text))
+
+
+def record(game_id, seq, text):
+    record_many([(game_id, seq, text)])
+
+
+def missed_events(game_id, last_seq, current_seq):
+    """
+    Textos de los eventos posteriores a last_seq, en orden, o None si el
+    buffer ya no los cubre y hace falta la instantánea completa.
+    """
+    if last_seq > current_seq:
+        return None
+    if redis_state.enabled():
+        entries = redis_state.get_redis().zrangebyscore(
+            events_key(game_id), f'({last_seq}', '+inf', withscores=True
+        )
+        entries = [(int(seq), text.decode()) for text, seq in entries]
+    else:
+        with _lock:
+            entries = [entry for entry in _local.get(game_id, ()) if entry[0] > last_seq]
+
+    if entries:
+        if entries[0][0] != last_seq + 1:
+            return None
+    elif current_seq > last_seq:
+        return None
+    return [text for _, text in entries]
@@ -3,6 +3,7 @@ from django.contrib.auth.forms import UserCreationForm
 from django.core.validators import MinValueValidator
 from django.core.exceptions import ValidationError
 import json
+from .engine import compile_pattern
 from .models import BankAccount, User, Game, CreditRequest, Raffle, PercentageSettings, WithdrawalRequest
 
 class RegistrationForm(UserCreationForm):
@@ -40,7 +41,7 @@ class GameForm(forms.ModelForm):
         model = Game
         fields = ['name', 'password', 'card_price', 
                  'max_cards_per_player', 'winning_pattern',
-                'base_prize', 'auto_call_interval', 'progressive_prizes','custom_pattern']
+                'base_prize', 'auto_call_interval', 'progressive_prizes','custom_pattern', 'prize_stages']
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -48,6 +49,13 @@ class GameForm(forms.ModelForm):
         self.fields['progressive_prizes'].widget = forms.HiddenInput()  # Ocultar campo raw
 
         self.fields['custom_pattern'].required = False
+
+        self.fields['prize_stages'].required = False
+        self.fields['prize_stages'].widget = forms.HiddenInput()
+        self.fields['prize_stages_json'] = forms.CharField(
+            required=False,
+            widget=forms.HiddenInput()
+        )
         
         # Añadir campo para subir un archivo JSON con el patrón
         self.fields['pattern_file'] = forms.FileField(
@@ -90,6 +98,36 @@ class GameForm(forms.ModelForm):
                 cleaned_data['progressive_prizes'] = prizes
             except (json.JSONDecodeError, TypeError):
                 raise forms.ValidationError("Formato de premios progresivos inválido")
+
+        # Procesar etapas de premio intermedias
+        prize_stages_json = self.data.get('prize_stages_json')
+        if prize_stages_json:
+            try:
+                stages = json.loads(prize_stages_json)
+                if not isinstance(stages, list) or not all(isinstance(stage, dict) for stage in stages):
+                    raise forms.ValidationError("Formato de etapas de premio inválido")
+                valid_patterns = dict(Game.WINNING_PATTERNS)
+                total_percentage = 0
+                for stage in stages:
+                    if stage.get('pattern') not in valid_patterns:
+                        raise forms.ValidationError("Patrón de etapa inválido")
+                    if stage['pattern'] == 'CUSTOM' and not cleaned_data.get('custom_pattern'):
+                        raise forms.ValidationError("Las etapas personalizadas requieren un patrón personalizado")
+                    stage['lines'] = int(stage.get('lines', 1))
+                    stage['percentage'] = float(stage['percentage'])
+                    if not 1 <= stage['lines'] <= 12 or stage['percentage'] <= 0:
+                        raise forms.ValidationError("Formato de etapas de premio inválido")
+                    available = len(compile_pattern(stage['pattern'], cleaned_data.get('custom_pattern')))
+                    if stage['lines'] > available:
+                        raise forms.ValidationError(
+                            f"La etapa {stage['pattern']} admite como mucho {available} línea(s)"
+                        )
+                    total_percentage += stage['percentage']
+                if total_percentage >= 100:
+                    raise forms.ValidationError("Las etapas intermedias deben repartir menos del 100% del premio")
+                cleaned_data['prize_stages'] = stages
+            except (json.JSONDecodeError, TypeError, KeyError, ValueError):
+                raise forms.ValidationError("Formato de etapas de premio inválido")
         
         return cleaned_data
     
@@ -0,0 +1,266 @@
+"""
+Estado en memoria de las partidas en curso.
+
+GameState guarda lo que una partida en juego necesita leer en cada bola
+(números llamados, cursor de extracción, premio, cartones y banderas) en un
+objeto compacto con __slots__. Con BINGO_REDIS_STATE, Redis es la fuente de
+verdad de cada bola y los cambios se acumulan en GameStateStore para
+escribirse en la base de datos por lotes, como mucho
+BINGO_STATE_FLUSH_INTERVAL segundos después (o antes si hay
+BINGO_STATE_FLUSH_BATCH partidas pendientes).
+
+Sin Redis la base de datos es la única fuente compartida con la vista
+call_number, así que no hay escritura diferida: draw_locked bloquea las
+filas, incorpora los números llamados a mano, extrae y guarda en la misma
+transacción, antes de difundir nada.
+
+Cada escritura es condicional sobre la secuencia que ya estaba guardada: si
+otro proceso llamó números a mano entretanto, se incorporan al estado y se
+vuelve a intentar, en lugar de pisarlos.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .engine import new_draw_seed, next_in_draw, numbers_mask
+from .models import Game
+
+
+logger = logging.getLogger(__name__)
+
+STATE_FIELDS = (
+    'id', 'is_started', 'is_finished', 'is_auto_calling', 'auto_call_interval',
+    'winning_pattern', 'custom_pattern', 'prize_stages', 'current_stage',
+    'current_number', 'called_mask', 'called_sequence', 'draw_seed', 'draw_cursor',
+    'current_prize', 'total_cards_sold', 'max_cards_sold', 'next_prize_target',
+)
+
+
+class GameState:
+    """Copia en memoria de una partida; se usa también en lugar de Game en winners.py"""
+    __slots__ = (
+        'id', 'is_started', 'is_finished', 'is_auto_calling', 'auto_call_interval',
+        'winning_pattern', 'custom_pattern', 'prize_stages', 'current_stage',
+        'current_number', 'called_mask_int', 'sequence', 'draw_seed', 'draw_cursor',
+        'current_prize', 'total_cards_sold', 'max_cards_sold', 'next_prize_target',
+        'persisted_sequence',
+    )
+
+    @classmethod
+    def from_game(cls, game):
+        state = cls()
+        for field in STATE_FIELDS:
+            if field not in ('called_mask', 'called_sequence'):
+                setattr(state, field, getattr(game, field))
+        state.called_mask_int = game.called_mask_int
+        state.sequence = bytearray(game.called_sequence)
+        state.persisted_sequence = bytes(state.sequence)
+        return state
+
+    @property
+    def is_running(self):
+        return self.is_started and not self.is_finished and self.is_auto_calling
+
+    @property
+    def called_numbers(self):
+        return list(self.sequence)
+
+    @property
+    def called_count(self):
+        return len(self.sequence)
+
+    @property
+    def is_dirty(self):
+        return self.persisted_sequence != self.sequence
+
+    @property
+    def progress_percentage(self):
+        if not self.next_prize_target:
+            return 0
+        return min(100, (self.total_cards_sold / self.next_prize_target) * 100)
+
+    def add_called_number(self, number):
+        self.called_mask_int |= 1 << number
+        self.sequence.append(number)
+        self.current_number = number
+
+    def draw_next_number(self):
+        """Igual que Game.draw_next_number pero sobre el estado en memoria (adopt asigna la semilla)"""
+        number, self.draw_cursor = next_in_draw(self.draw_seed, self.draw_cursor, self.called_mask_int)
+        if number is not None:
+            self.add_called_number(number)
+        return number
+
+    def apply_draw(self, cursor, sequence):
+        """Adopta el resultado de una extracción hecha en Redis (secuencia completa y cursor)"""
+        self.draw_cursor = cursor
+        if len(sequence) != len(self.sequence):
+            self.sequence = bytearray(sequence)
+            self.called_mask_int = numbers_mask(self.sequence)
+            self.current_number = self.sequence[-1] if self.sequence else None
+
+    def merge_persisted(self, sequence):
+        """Incorpora los números guardados por otro proceso que aún no están en memoria"""
+        sequence = bytes(sequence)
+        for number in sequence:
+            if not self.called_mask_int >> number & 1:
+                self.add_called_number(number)
+        self.persisted_sequence = sequence
+
+    def status(self):
+        """Datos que el consumer envía en game_status"""
+        return {
+            'is_started': self.is_started,
+            'is_finished': self.is_finished,
+            'is_auto_calling': self.is_auto_calling,
+            'current_number': self.current_number,
+            'called_numbers': self.called_numbers,
+            'current_prize': self.current_prize,
+            'total_cards_sold': self.total_cards_sold,
+            'next_prize_target': self.next_prize_target,
+            'progress_percentage': self.progress_percentage
+        }
+
+
+def _persist_draw_seed(game):
+    """
+    Asigna y guarda la semilla de una partida que no la tiene (empezada antes
+    de draw_seed). La escritura es condicional para que todos los procesos
+    acaben con la misma semilla y el mismo orden de extracción.
+    """
+    Game.objects.filter(id=game.id, draw_seed__isnull=True).update(draw_seed=new_draw_seed(), draw_cursor=0)
+    game.draw_seed, game.draw_cursor = Game.objects.filter(id=game.id).values_list('draw_seed', 'draw_cursor').get()
+
+
+class GameStateStore:
+    """Estados de las partidas en curso de este proceso con escritura diferida por lotes"""
+
+    def __init__(self, flush_interval=None, flush_batch=None):
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'BINGO_STATE_FLUSH_INTERVAL', 1.0)
+        if flush_batch is None:
+            flush_batch = getattr(settings, 'BINGO_STATE_FLUSH_BATCH', 500)
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.states = {}
+        self.dirty = set()
+        self.oldest_dirty = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.states)
+
+    def peek(self, game_id):
+        return self.states.get(game_id)
+
+    def get_many(self, game_ids):
+        """Estados de las partidas indicadas, cargando de una vez las que falten"""
+        missing = [game_id for game_id in game_ids if game_id not in self.states]
+        if missing:
+            for game in Game.objects.filter(id__in=missing).only(*STATE_FIELDS):
+                self.adopt(game)
+        return [self.states[game_id] for game_id in game_ids if game_id in self.states]
+
+    def adopt(self, game):
+        """Registra el estado de un Game ya cargado (si no había uno en memoria)"""
+        state = self.states.get(game.id)
+        if state is None:
+            if game.draw_seed is None:
+                _persist_draw_seed(game)
+            state = self.states[game.id] = GameState.from_game(game)
+        return state
+
+    def get(self, game_id):
+        states = self.get_many([game_id])
+        return states[0] if states else None
+
+    def mark_dirty(self, game_id):
+        with self.lock:
+            if not self.dirty:
+                self.oldest_dirty = time.monotonic()
+            self.dirty.add(game_id)
+
+    def flush_due(self):
+        """Momento (time.monotonic) en que vence la próxima escritura, o None"""
+        if not self.dirty:
+            return None
+        if len(self.dirty) >= self.flush_batch:
+            return self.oldest_dirty
+        return self.oldest_dirty + self.flush_interval
+
+    def merge_persisted(self, sequences):
+        """Aplica {game_id: called_sequence} leído de la base de datos a los estados cargados"""
+        for game_id, sequence in sequences.items():
+            state = self.states.get(game_id)
+            if state is not None and bytes(sequence) != state.persisted_sequence:
+                state.merge_persisted(sequence)
+                if state.is_dirty:
+                    self.mark_dirty(game_id)
+
+    def _persist(self, state):
+        for _ in range(2):
+            sequence = bytes(state.sequence)
+            updated = Game.objects.filter(id=state.id, called_sequence=state.persisted_sequence).update(
+                current_number=state.current_number,
+                called_mask=state.called_mask_int.to_bytes(16, 'little'),
+                called_sequence=sequence,
+                draw_seed=state.draw_seed,
+                draw_cursor=state.draw_cursor,
+            )
+            if updated:
+                state.persisted_sequence = sequence
+                return True
+            # Otro proceso cambió la secuencia: incorporarla y reintentar
+            persisted = Game.objects.filter(id=state.id).values_list('called_sequence', flat=True).first()
+            if persisted is None:
+                return False
+            state.merge_persisted(persisted)
+        logger.warning("No se pudo guardar el estado de la partida %s", state.id)
+        return False
+
+    def draw_locked(self, states):
+        """
+        Extrae una bola de cada estado sin escritura diferida: con las filas
+        bloqueadas (la vista call_number bloquea la misma fila) incorpora los
+        números guardados, extrae y persiste. Devuelve los números (None si
+        la partida no tiene más bolas).
+        """
+        with transaction.atomic():
+            persisted = dict(
+                Game.objects.select_for_update().filter(id__in=[state.id for state in states])
+                .order_by('id').values_list('id', 'called_sequence')
+            )
+            numbers = []
+            for state in states:
+                sequence = persisted.get(state.id)
+                if sequence is not None and bytes(sequence) != state.persisted_sequence:
+                    state.merge_persisted(sequence)
+                numbers.append(state.draw_next_number())
+                self._persist(state)
+        return numbers
+
+    def flush(self, game_ids=None):
+        """Escribe en la base de datos los estados pendientes (todos o los indicados)"""
+        with self.lock:
+            ids = set(self.dirty) if game_ids is None else self.dirty & set(game_ids)
+            self.dirty -= ids
+            if not self.dirty:
+                self.oldest_dirty = None
+        states = [self.states[game_id] for game_id in ids if game_id in self.states]
+        if not states:
+            return 0
+        with transaction.atomic():
+            for state in states:
+                self._persist(state)
+        return len(states)
+
+    def evict(self, game_id):
+        """Guarda y olvida el estado de una partida (al terminar o dejar de llamar)"""
+        self.flush([game_id])
+        self.states.pop(game_id, None)
+
+
+game_states = GameStateStore()
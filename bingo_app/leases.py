@@ -0,0 +1,100 @@
+"""
+Concesiones (leases) por partida para que un solo proceso cante sus números.
+
+Cada planificador intenta adquirir `bingo:{game:<id>}:lease` con SET NX PX y
+la renueva en cada latido (BINGO_LEASE_HEARTBEAT). Si el proceso muere, la
+concesión caduca a los BINGO_LEASE_TTL_MS milisegundos y otro planificador la
+toma en su siguiente latido. Renovar y liberar solo funcionan para el dueño
+actual (scripts Lua que comparan el token), y cada extracción en Redis
+comprueba el mismo token (redis_state.CALL_NEXT_SCRIPT), de modo que un
+worker que perdió la concesión a mitad de un tick largo no sigue cantando.
+
+Sin estado compartido en Redis (BINGO_REDIS_STATE desactivado) se usa
+LocalLeaseManager, que concede todas las partidas al proceso actual.
+"""
+import os
+import secrets
+import socket
+
+from django.conf import settings
+
+from . import redis_state
+
+
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LocalLeaseManager:
+    """Un único proceso: todas las partidas le pertenecen"""
+    token = None
+
+    def acquire(self, game_ids):
+        return set(game_ids)
+
+    def renew(self, game_ids):
+        return set(game_ids)
+
+    def release(self, game_ids):
+        pass
+
+
+class RedisLeaseManager:
+
+    def __init__(self, ttl_ms=None):
+        if ttl_ms is None:
+            ttl_ms = getattr(settings, 'BINGO_LEASE_TTL_MS', 2000)
+        self.ttl_ms = ttl_ms
+        self.token = f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}'
+        client = redis_state.get_redis()
+        self._renew = client.register_script(RENEW_SCRIPT)
+        self._release = client.register_script(RELEASE_SCRIPT)
+
+    def _pipeline(self):
+        return redis_state.get_redis().pipeline(transaction=False)
+
+    def acquire(self, game_ids):
+        """Intenta adquirir las concesiones libres; devuelve las obtenidas"""
+        game_ids = list(game_ids)
+        if not game_ids:
+            return set()
+        pipe = self._pipeline()
+        for game_id in game_ids:
+            pipe.set(redis_state.lease_key(game_id), self.token, nx=True, px=self.ttl_ms)
+        return {game_id for game_id, ok in zip(game_ids, pipe.execute()) if ok}
+
+    def renew(self, game_ids):
+        """Renueva las concesiones propias; devuelve las que se siguen teniendo"""
+        game_ids = list(game_ids)
+        if not game_ids:
+            return set()
+        pipe = self._pipeline()
+        for game_id in game_ids:
+            self._renew(keys=[redis_state.lease_key(game_id)], args=[self.token, self.ttl_ms], client=pipe)
+        return {game_id for game_id, ok in zip(game_ids, pipe.execute()) if ok}
+
+    def release(self, game_ids):
+        game_ids = list(game_ids)
+        if not game_ids:
+            return
+        pipe = self._pipeline()
+        for game_id in game_ids:
+            self._release(keys=[redis_state.lease_key(game_id)], args=[self.token], client=pipe)
+        pipe.execute()
+
+
+def get_lease_manager():
+    if redis_state.enabled():
+        return RedisLeaseManager()
+    return LocalLeaseManager()
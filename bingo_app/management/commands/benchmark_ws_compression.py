@@ -0,0 +1,139 @@
+import json
+import random
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from bingo_app.broadcast import group_event, number_called_event
+from bingo_app.engine import draw_order
+from bingo_project.websocket import COMPRESS_SETTINGS, MAX_WINDOW_BITS, ThresholdPerMessageDeflate
+from websockets.frames import OP_TEXT, Frame
+
+
+DEFAULT_THRESHOLDS = [0, 64, 128, 256, 512, 1024]
+CHAT_WORDS = (
+    'hola suerte bingo vamos casi me falta uno dos tres cartón premio línea '
+    'esquinas qué rápido otra vez buena jugada ganamos número ya nada todavía'
+).split()
+
+
+def _status_text(called, cards_sold, prize, target):
+    """game_status como lo construye snapshots.py"""
+    return json.dumps({
+        'type': 'game_status',
+        'is_started': bool(called),
+        'is_finished': False,
+        'is_auto_calling': bool(called),
+        'current_number': called[-1] if called else None,
+        'called_numbers': called,
+        'current_prize': prize,
+        'total_cards_sold': cards_sold,
+        'next_prize_target': target,
+        'progress_percentage': min(100, cards_sold / target * 100),
+        'seq': len(called),
+    })
+
+
+def _chat_text(rng, users):
+    return group_event('chat_batch', messages=[
+        {
+            'user': rng.choice(users),
+            'message': ' '.join(rng.choice(CHAT_WORDS) for _ in range(rng.randint(1, 8))),
+            'timestamp': datetime.now().isoformat(),
+        }
+        for _ in range(rng.randint(1, 5))
+    ])['text']
+
+
+def _socket_stream(rng, purchases, chat_every, users):
+    """Mensajes (tipo, texto) que recibe un socket durante una partida completa"""
+    prize, cards_sold, target = 100.0, rng.randint(0, 50), 500
+    stream = [('game_status', _status_text([], cards_sold, prize, target))]
+    for _ in range(purchases):
+        cards_sold += 1
+        increase = 0.5 if rng.random() < 0.3 else 0
+        prize += increase
+        stream.append(('prize_updated', group_event(
+            'prize_updated', new_prize=prize, increase_amount=increase, total_cards=cards_sold,
+            next_target=target, progress_percentage=min(100, cards_sold / target * 100),
+        )['text']))
+        stream.append(('card_purchased', group_event(
+            'card_purchased', prize_increased=increase > 0, new_prize=prize, increase_amount=increase,
+            total_cards_sold=cards_sold, max_cards_sold=cards_sold, next_prize_target=target,
+            progress_percentage=min(100, cards_sold / target * 100),
+        )['text']))
+    stream.append(('game_started', group_event(
+        'game_started', is_started=True, is_auto_calling=False,
+        total_cards_sold=cards_sold, max_cards_sold=cards_sold,
+    )['text']))
+    stream.append(('auto_call_toggled', group_event('auto_call_toggled', is_auto_calling=True)['text']))
+
+    called = []
+    resync_at = rng.randint(10, 60)
+    for number in draw_order(rng.getrandbits(63)):
+        called.append(number)
+        stream.append(('number_called', number_called_event(number, len(called))['text']))
+        if len(called) % chat_every == 0:
+            stream.append(('chat_batch', _chat_text(rng, users)))
+        if len(called) == resync_at:
+            # Reconexión sin buffer: instantánea completa
+            stream.append(('game_status', _status_text(list(called), cards_sold, prize, target)))
+    stream.append(('game_ended', group_event(
+        'game_ended', winner=rng.choice(users), prize=prize, called_numbers=called,
+    )['text']))
+    return [(event_type, text.encode()) for event_type, text in stream]
+
+
+class Command(BaseCommand):
+    help = "Mide bytes enviados y CPU de permessage-deflate según el umbral de compresión"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=200, help="Conexiones simuladas")
+        parser.add_argument('--purchases', type=int, default=40, help="Compras vistas por cada socket antes de empezar")
+        parser.add_argument('--chat-every', type=int, default=3, help="Un chat_batch cada N bolas")
+        parser.add_argument('--thresholds', type=int, nargs='+', default=DEFAULT_THRESHOLDS)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        users = [f'jugador{i}' for i in range(50)]
+        streams = [
+            _socket_stream(rng, options['purchases'], options['chat_every'], users)
+            for _ in range(options['sockets'])
+        ]
+        messages = sum(len(stream) for stream in streams)
+        raw_bytes = sum(len(data) for stream in streams for _, data in stream)
+        self.stdout.write(
+            f"{options['sockets']} sockets, {messages:,} mensajes, {raw_bytes / 1024:,.0f} KiB sin comprimir"
+        )
+
+        self.stdout.write(self.style.MIGRATE_HEADING("\nUmbral   KiB enviados   ahorro   CPU (ms)   µs/mensaje   comprimidos"))
+        per_type = None
+        for threshold in sorted(options['thresholds']):
+            sent = 0
+            compressed = 0
+            sizes = {}
+            start = time.process_time()
+            for stream in streams:
+                extension = ThresholdPerMessageDeflate(
+                    False, False, MAX_WINDOW_BITS, MAX_WINDOW_BITS, COMPRESS_SETTINGS, min_size=threshold
+                )
+                for event_type, data in stream:
+                    frame = extension.encode(Frame(OP_TEXT, data))
+                    sent += len(frame.data)
+                    compressed += frame.rsv1
+                    raw, wire, count = sizes.get(event_type, (0, 0, 0))
+                    sizes[event_type] = (raw + len(data), wire + len(frame.data), count + 1)
+            cpu = time.process_time() - start
+            if threshold == 0:
+                per_type = sizes
+            self.stdout.write(
+                f"{threshold:>6}   {sent / 1024:>12,.0f}   {1 - sent / raw_bytes:>6.1%}   {cpu * 1000:>8,.1f}   "
+                f"{cpu / messages * 1e6:>10.2f}   {compressed / messages:>10.1%}"
+            )
+
+        if per_type:
+            self.stdout.write(self.style.MIGRATE_HEADING("\nTamaño medio por evento (bytes, comprimiendo todo)"))
+            for event_type, (raw, wire, count) in sorted(per_type.items(), key=lambda item: -item[1][0]):
+                self.stdout.write(f"  {event_type:<18} {raw / count:>8.0f} -> {wire / count:>6.0f}   ({count:,} mensajes)")
@@ -0,0 +1,29 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from bingo_app.scheduler import GameScheduler
+
+
+class Command(BaseCommand):
+    help = "Worker que canta los números de todas las partidas con llamada automática"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reconcile-interval', type=float,
+            help="Segundos entre revisiones de las partidas activas en la base de datos"
+        )
+
+    def handle(self, *args, **options):
+        scheduler = GameScheduler(reconcile_interval=options['reconcile_interval'])
+        self.stdout.write(
+            f"Planificador de partidas iniciado (revisión cada {scheduler.reconcile_interval}s)"
+        )
+        try:
+            asyncio.run(scheduler.run(listen=True))
+        except KeyboardInterrupt:
+            stats = scheduler.stats
+            self.stdout.write(
+                f"Planificador detenido: {stats['balls']} bolas en {stats['ticks']} ticks, "
+                f"retraso máximo {stats['max_drift']:.3f}s, medio {stats['avg_drift']:.3f}s"
+            )
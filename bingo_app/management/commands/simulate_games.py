@@ -0,0 +1,152 @@
+import json
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bingo_app.engine import GameCardArray, GameCardIndex, encode_card, game_stages
+from bingo_app.models import Game, Player
+from bingo_app.utils import generate_bingo_card
+
+
+def _simulated_game(pattern, custom_pattern, seed):
+    """Partida en memoria: usa el código real de Game pero sin escribir en la base de datos"""
+    game = Game(name='simulación', winning_pattern=pattern, custom_pattern=custom_pattern, draw_seed=seed)
+    game.save = lambda *args, **kwargs: None
+    return game
+
+
+def _check_bingo_engine(game, cards):
+    players = []
+    for card in cards:
+        player = Player(game=game)
+        player._cards_cache = [card]
+        players.append(player)
+
+    def check():
+        for player in players:
+            if player.check_bingo():
+                return True
+        return False
+    return check
+
+
+def _stage_engine(engine_class):
+    def build(game, cards):
+        engine = engine_class(game_stages(game))
+        for card_id, card in enumerate(cards):
+            engine.add_card(card_id, card_id, encode_card(card))
+        return lambda: bool(engine.sync(game.called_numbers)[-1])
+    return build
+
+
+ENGINES = {
+    'check_bingo': _check_bingo_engine,
+    'index': _stage_engine(GameCardIndex),
+    'numpy': _stage_engine(GameCardArray),
+}
+
+DEFAULT_PATTERNS = ['HORIZONTAL', 'VERTICAL', 'DIAGONAL', 'CORNERS', 'FULL']
+
+
+class Command(BaseCommand):
+    help = "Simula partidas completas para medir el rendimiento del motor de bingo"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=10, help="Partidas por patrón")
+        parser.add_argument('--cards', type=int, default=500, help="Cartones por partida")
+        parser.add_argument(
+            '--patterns', nargs='+', default=DEFAULT_PATTERNS,
+            choices=[value for value, _ in Game.WINNING_PATTERNS]
+        )
+        parser.add_argument('--custom-pattern', help="Archivo JSON con la matriz 5x5 para CUSTOM")
+        parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+        parser.add_argument('--seed', type=int, help="Semilla para reproducir la simulación")
+
+    def handle(self, *args, **options):
+        custom_pattern = None
+        if options['custom_pattern']:
+            with open(options['custom_pattern']) as pattern_file:
+                custom_pattern = json.load(pattern_file)
+        elif 'CUSTOM' in options['patterns']:
+            raise CommandError("CUSTOM requiere --custom-pattern")
+
+        rng = random.Random(options['seed'])
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+
+        engines = options['engines']
+        self.stdout.write(
+            f"Simulando {options['games']} partidas x {options['cards']} cartones "
+            f"por patrón con motores: {', '.join(engines)}"
+        )
+
+        for pattern in options['patterns']:
+            stats = {name: {'check_time': 0.0, 'cards_checked': 0} for name in engines}
+            call_time = 0.0
+            calls = 0
+            balls_to_win = []
+
+            for _ in range(options['games']):
+                cards = [generate_bingo_card() for _ in range(options['cards'])]
+                seed = rng.getrandbits(63)
+                results = {}
+
+                for name in engines:
+                    game = _simulated_game(pattern, custom_pattern, seed)
+                    check = ENGINES[name](game, cards)
+                    balls = None
+                    while True:
+                        start = time.perf_counter()
+                        number = game.call_number()
+                        call_time += time.perf_counter() - start
+                        calls += 1
+                        if number is None:
+                            break
+
+                        start = time.perf_counter()
+                        won = check()
+                        stats[name]['check_time'] += time.perf_counter() - start
+                        stats[name]['cards_checked'] += len(cards)
+                        if won:
+                            balls = game.called_count
+                            break
+                    results[name] = balls
+
+                if len(set(results.values())) > 1:
+                    raise CommandError(f"Los motores no coinciden en {pattern}: {results}")
+                if results[engines[0]] is not None:
+                    balls_to_win.append(results[engines[0]])
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n{pattern}"))
+            if balls_to_win:
+                deciles = statistics.quantiles(balls_to_win, n=10, method='inclusive') if len(balls_to_win) > 1 else balls_to_win * 9
+                self.stdout.write(
+                    f"  Bolas hasta ganar: min {min(balls_to_win)}  p10 {deciles[0]:.0f}  "
+                    f"p50 {statistics.median(balls_to_win):.0f}  media {statistics.mean(balls_to_win):.1f}  "
+                    f"p90 {deciles[-1]:.0f}  max {max(balls_to_win)}"
+                )
+            else:
+                self.stdout.write("  Ninguna partida tuvo ganador")
+            self.stdout.write(f"  Game.call_number: {calls / call_time if call_time else 0:,.0f} llamadas/s")
+            for name in engines:
+                engine_stats = stats[name]
+                throughput = engine_stats['cards_checked'] / engine_stats['check_time'] if engine_stats['check_time'] else 0
+                self.stdout.write(
+                    f"  {name:<12} {throughput:>14,.0f} cartones verificados/s  "
+                    f"({engine_stats['check_time'] * 1000:,.1f} ms en total)"
+                )
+
+        self.stdout.write(self.style.MIGRATE_HEADING("\nMemoria"))
+        cards = [generate_bingo_card() for _ in range(options['cards'])]
+        for name in engines:
+            tracemalloc.start()
+            ENGINES[name](_simulated_game(options['patterns'][0], custom_pattern, 0), cards)()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stdout.write(f"  {name:<12} {peak / 1024:,.0f} KiB para {options['cards']} cartones")
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stdout.write(f"  Pico de memoria del proceso: {max_rss / 1024:,.0f} MiB")
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-17 00:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo_app', '0012_percentagesettings_entry_commission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='draw_cursor',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='draw_seed',
+            field=models.BigIntegerField(blank=True, help_text='Semilla del orden de extracción (permite auditar y reproducir el sorteo)', null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.2 on 2026-10-17 00:45
+
+from django.db import migrations, models
+
+
+def copy_called_numbers(apps, schema_editor):
+    Game = apps.get_model('bingo_app', 'Game')
+    for game in Game.objects.exclude(called_numbers=[]).only('id', 'called_numbers').iterator():
+        mask = 0
+        sequence = bytearray()
+        for number in game.called_numbers or []:
+            number = int(number)
+            if not mask >> number & 1:
+                mask |= 1 << number
+                sequence.append(number)
+        Game.objects.filter(id=game.id).update(
+            called_mask=mask.to_bytes(16, 'little'),
+            called_sequence=bytes(sequence),
+        )
+
+
+def restore_called_numbers(apps, schema_editor):
+    Game = apps.get_model('bingo_app', 'Game')
+    for game in Game.objects.only('id', 'called_sequence').iterator():
+        Game.objects.filter(id=game.id).update(called_numbers=list(bytes(game.called_sequence)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo_app', '0013_game_draw_seed_game_draw_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='called_mask',
+            field=models.BinaryField(default=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='called_sequence',
+            field=models.BinaryField(default=b'', max_length=128),
+        ),
+        migrations.RunPython(copy_called_numbers, restore_called_numbers),
+        migrations.RemoveField(
+            model_name='game',
+            name='called_numbers',
+        ),
+    ]
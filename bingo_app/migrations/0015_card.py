@@ -0,0 +1,57 @@
+# Generated by Django 5.2.2 on 2026-10-17 00:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_player_cards(apps, schema_editor):
+    Player = apps.get_model('bingo_app', 'Player')
+    Card = apps.get_model('bingo_app', 'Card')
+    batch = []
+    for player in Player.objects.only('id', 'game_id', 'cards').iterator():
+        for card in player.cards or []:
+            numbers = bytes(int(num) for row in card for num in row)
+            batch.append(Card(game_id=player.game_id, player_id=player.id, numbers=numbers))
+        if len(batch) >= 1000:
+            Card.objects.bulk_create(batch)
+            batch = []
+    Card.objects.bulk_create(batch)
+
+
+def restore_player_cards(apps, schema_editor):
+    Player = apps.get_model('bingo_app', 'Player')
+    Card = apps.get_model('bingo_app', 'Card')
+    cards = {}
+    for player_id, numbers in Card.objects.order_by('id').values_list('player_id', 'numbers').iterator():
+        data = bytes(numbers)
+        cards.setdefault(player_id, []).append([list(data[i:i + 5]) for i in range(0, 25, 5)])
+    for player_id, player_cards in cards.items():
+        Player.objects.filter(id=player_id).update(cards=player_cards)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo_app', '0014_compact_called_numbers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Card',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('numbers', models.BinaryField(max_length=25)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bingo_cards', to='bingo_app.game')),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bingo_cards', to='bingo_app.player')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.RunPython(copy_player_cards, restore_player_cards),
+        migrations.RemoveField(
+            model_name='player',
+            name='cards',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-17 00:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo_app', '0015_card'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='current_stage',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='prize_stages',
+            field=models.JSONField(blank=True, default=list, help_text="[{'pattern': 'HORIZONTAL', 'lines': 1, 'percentage': 20}, ...]"),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-17 00:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo_app', '0016_game_prize_stages'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='card',
+            name='player',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='bingo_cards', to='bingo_app.player'),
+        ),
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(fields=['game', 'player'], name='card_game_player_idx'),
+        ),
+    ]
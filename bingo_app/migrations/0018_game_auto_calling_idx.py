@@ -0,0 +1,17 @@
+# Generated by Django 5.2.2 on 2026-10-17 00:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo_app', '0017_card_pool'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('is_auto_calling', True), ('is_finished', False), ('is_started', True)), fields=['id'], name='game_auto_calling_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.2 on 2026-10-17 13:05
+
+import secrets
+
+from django.db import migrations
+
+
+def backfill_draw_seed(apps, schema_editor):
+    # Partidas en curso empezadas antes de draw_seed: sin semilla el planificador no puede extraer
+    Game = apps.get_model('bingo_app', 'Game')
+    pending = Game.objects.filter(is_started=True, is_finished=False, draw_seed__isnull=True)
+    for game_id in pending.values_list('id', flat=True).iterator():
+        Game.objects.filter(id=game_id, draw_seed__isnull=True).update(draw_seed=secrets.randbits(63), draw_cursor=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo_app', '0018_game_auto_calling_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_draw_seed, migrations.RunPython.noop),
+    ]
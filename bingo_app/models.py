@@ -11,6 +11,11 @@ from django.db import transaction
 from django.shortcuts import get_object_or_404
 from asgiref.sync import async_to_sync  # Necesario para llamadas síncronas a Channels
 from channels.layers import get_channel_layer  # Para enviar mensajes via WebSocket
+from django.conf import settings
+from .broadcast import group_send_sync
+from .engine import (
+    compile_card, decode_card, game_pattern_masks, game_stages, generate_unique_cards, is_winning_mask, marked_mask, new_draw_seed, next_in_draw, numbers_mask
+)
 
 
 class User(AbstractUser):
@@ -110,6 +115,15 @@ class Game(models.Model):
         default=1,
         validators=[MinValueValidator(1)]
     )
+
+    # Etapas de premio intermedias (p. ej. primera línea, dos líneas) antes del
+    # patrón final; cada una reparte un porcentaje de la parte de los jugadores
+    prize_stages = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="[{'pattern': 'HORIZONTAL', 'lines': 1, 'percentage': 20}, ...]"
+    )
+    current_stage = models.PositiveSmallIntegerField(default=0)
     
     # Game state
     is_started = models.BooleanField(default=False)
@@ -122,9 +136,19 @@ class Game(models.Model):
         related_name='won_games'
     )
     
-    # Called numbers
+    # Called numbers: máscara de 128 bits (bit n = número n llamado) y secuencia
+    # de solo-añadir con un byte por número en orden de llamada
     current_number = models.IntegerField(null=True, blank=True)
-    called_numbers = models.JSONField(default=list)
+    called_mask = models.BinaryField(max_length=16, default=bytes(16))
+    called_sequence = models.BinaryField(max_length=128, default=b'')
+
+    # Orden de extracción: permutación generada a partir de la semilla al iniciar
+    draw_seed = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text="Semilla del orden de extracción (permite auditar y reproducir el sorteo)"
+    )
+    draw_cursor = models.PositiveSmallIntegerField(default=0)
     
     # Progressive prizes system
     base_prize = models.PositiveIntegerField(
@@ -161,6 +185,16 @@ class Game(models.Model):
     )
     is_auto_calling = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Índice parcial: solo las partidas que el planificador debe cantar
+            models.Index(
+                fields=['id'],
+                condition=models.Q(is_auto_calling=True, is_started=True, is_finished=False),
+                name='game_auto_calling_idx',
+            ),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -171,37 +205,185 @@ class Game(models.Model):
             return 0
         return min(100, (self.total_cards_sold / self.next_prize_target) * 100)
     
+    @property
+    def called_numbers(self):
+        """Números llamados en orden (solo lectura; usar register_called_number para añadir)"""
+        return list(bytes(self.called_sequence))
+
+    @property
+    def called_mask_int(self):
+        return int.from_bytes(bytes(self.called_mask), 'little')
+
+    @property
+    def called_count(self):
+        return len(self.called_sequence)
+
+    def is_called(self, number):
+        return bool(self.called_mask_int >> number & 1)
+
+    def last_called(self, count=1):
+        """Últimos `count` números llamados, del más antiguo al más reciente"""
+        if count <= 0:
+            return []
+        return list(bytes(self.called_sequence)[-count:])
+
+    def add_called_number(self, number):
+        """Marca un número en memoria y devuelve los campos a persistir"""
+        self.called_mask = (self.called_mask_int | 1 << number).to_bytes(16, 'little')
+        self.called_sequence = bytes(self.called_sequence) + bytes([number])
+        self.current_number = number
+        return ['current_number', 'called_mask', 'called_sequence']
+
+    def apply_called_sequence(self, sequence):
+        """Sustituye los números llamados por una secuencia completa (p. ej. la de Redis)"""
+        sequence = bytes(sequence)
+        self.called_sequence = sequence
+        self.called_mask = numbers_mask(sequence).to_bytes(16, 'little')
+        self.current_number = sequence[-1] if sequence else None
+        return ['current_number', 'called_mask', 'called_sequence']
+
+    def register_called_number(self, number):
+        self.save(update_fields=self.add_called_number(number))
+
     # @property
     # def remaining_cards(self):
     #     if not self.next_prize_target:
     #         return 0
     #     return max(0, self.next_rize_target - self.total_cards_sold)
     
+    def discard_shared_state(self):
+        """Borra el estado compartido en Redis de una partida terminada"""
+        from . import redis_state
+        if redis_state.enabled():
+            redis_state.discard_game_state(self.id)
+
+    def ensure_draw_seed(self):
+        """Asigna la semilla del orden de extracción si aún no tiene una"""
+        if self.draw_seed is None:
+            self.draw_seed = new_draw_seed()
+            self.draw_cursor = 0
+        return self.draw_seed
+
+    DRAW_FIELDS = ['current_number', 'called_mask', 'called_sequence', 'draw_seed', 'draw_cursor']
+
+    def draw_next_number(self):
+        """
+        Avanza el cursor sobre el orden precalculado, saltando números ya
+        llamados a mano. Solo modifica la instancia (ver DRAW_FIELDS).
+        """
+        number, self.draw_cursor = next_in_draw(self.ensure_draw_seed(), self.draw_cursor, self.called_mask_int)
+        if number is not None:
+            self.add_called_number(number)
+        return number
+
     def call_number(self):
-        available_numbers = [n for n in range(1, 76) if n not in self.called_numbers]
-        if available_numbers:
-            number = random.choice(available_numbers)
-            self.current_number = number
-            self.called_numbers.append(number)
-            self.save()
-            return number
-        return None
+        number = self.draw_next_number()
+        if number is None:
+            self.save(update_fields=['draw_seed', 'draw_cursor'])
+            return None
+
+        self.save(update_fields=self.DRAW_FIELDS)
+        return number
+    
+    def generate_card_pool(self, size=None):
+        """
+        Pre-genera cartones únicos sin dueño para la venta. Bloquea la fila de la
+        partida para que dos recargas simultáneas no generen duplicados.
+        """
+        size = size or getattr(settings, 'BINGO_CARD_POOL_SIZE', 500)
+        with transaction.atomic():
+            Game.objects.select_for_update().filter(id=self.id).first()
+            existing = Card.objects.filter(game=self).values_list('numbers', flat=True)
+            pool = [
+                Card(game=self, numbers=numbers)
+                for numbers in generate_unique_cards(size, exclude=existing.iterator())
+            ]
+            Card.objects.bulk_create(pool, batch_size=1000)
+        return len(pool)
+
+    def stage_label(self, stage_index):
+        if stage_index >= len(self.prize_stages or []):
+            return self.get_winning_pattern_display()
+        stage = self.prize_stages[stage_index]
+        label = dict(self.WINNING_PATTERNS).get(stage['pattern'], stage['pattern'])
+        lines = int(stage.get('lines', 1))
+        return f"{label} x{lines}" if lines > 1 else label
+
+    def final_stage_share(self):
+        """Fracción de la parte de los jugadores que queda para la etapa final"""
+        # Solo cuentan las etapas ya resueltas; las que nadie completó pasan al premio final
+        resolved = (self.prize_stages or [])[:self.current_stage]
+        paid = sum(Decimal(str(stage.get('percentage', 0))) for stage in resolved)
+        return max(Decimal('0'), Decimal('100') - paid) / 100
+
+    def award_stage(self, stage_index, winners):
+        """Paga una etapa intermedia a sus ganadores y avanza a la siguiente"""
+        stage = self.prize_stages[stage_index]
+        self.current_stage = stage_index + 1
+        self.save(update_fields=['current_stage'])
+
+        percentage_settings = PercentageSettings.objects.first()
+        if not percentage_settings or not winners or self.current_prize <= 0:
+            return False
+
+        stage_prize = (
+            self.current_prize
+            * Decimal(percentage_settings.player_percentage / 100)
+            * Decimal(str(stage.get('percentage', 0))) / 100
+        )
+        prize_per_winner = stage_prize / len(winners)
+        label = self.stage_label(stage_index)
+
+        try:
+            with transaction.atomic():
+                for winner in winners:
+                    winner.credit_balance += prize_per_winner
+                    winner.save()
+
+                    Transaction.objects.create(
+                        user=winner,
+                        amount=prize_per_winner,
+                        transaction_type='PRIZE',
+                        description=f"Premio de etapa '{label}' en {self.name}",
+                        related_game=self
+                    )
+        except Exception as e:
+            logger.error(f"Error en award_stage: {str(e)}", exc_info=True)
+            return False
+
+        channel_layer = get_channel_layer()
+        group_send_sync(
+            f'game_{self.id}',
+            'stage_won',
+            stage=stage_index,
+            label=label,
+            winners=[winner.username for winner in winners],
+            prize=float(prize_per_winner)
+        )
+        for winner in winners:
+            async_to_sync(channel_layer.group_send)(
+                f"user_{winner.id}",
+                {
+                    'type': 'win_notification',
+                    'message': f"¡Ganaste {prize_per_winner:.2f} créditos en la etapa '{label}' de {self.name}",
+                }
+            )
+        return True
     
     def start_game(self):
         if not self.is_started and not self.is_finished:
             self.is_started = True
+            self.ensure_draw_seed()
+            # Compilar y cachear las máscaras de todas las etapas al iniciar
+            game_stages(self)
             self.save()
             
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f'game_{self.id}',
-                {
-                    'type': 'game_started',
-                    'is_started': True,
-                    'total_cards_sold': self.total_cards_sold,
-                    'max_cards_sold': self.max_cards_sold,  # Asegúrate de enviar esto
-
-                }
+            group_send_sync(
+                f'game_{self.id}', 'game_started',
+                is_started=True,
+                is_auto_calling=self.is_auto_calling,
+                total_cards_sold=self.total_cards_sold,
+                max_cards_sold=self.max_cards_sold,
             )
             return True
         return False
@@ -209,12 +391,10 @@ class Game(models.Model):
     def end_game(self):
         if not self.is_finished and self.is_started:
             # Encontrar todos los jugadores que han hecho bingo
-            players = Player.objects.filter(game=self)
-            winners = []
-            
-            for player in players:
-                if player.check_bingo():
-                    winners.append(player.user)
+            from .winners import discard_game_index, find_winners
+            winners = [player.user for player in find_winners(self)]
+            discard_game_index(self.id)
+            self.discard_shared_state()
             
             if not winners:
                 # No hay ganadores, terminar el juego sin premio
@@ -239,7 +419,7 @@ class Game(models.Model):
                     num_winners = len(winners)
                     
                     # Parte del premio que va a los jugadores (dividido entre ganadores)
-                    player_prize_per_winner = (self.current_prize * Decimal(percentage_settings.player_percentage / 100)) / num_winners
+                    player_prize_per_winner = (self.current_prize * Decimal(percentage_settings.player_percentage / 100) * self.final_stage_share()) / num_winners
                     
                     # Parte del organizador
                     organizer_prize = self.current_prize * Decimal(percentage_settings.organizer_percentage / 100)
@@ -341,6 +521,10 @@ class Game(models.Model):
                 winners = [winners]
             
             self.save()
+
+            from .winners import discard_game_index
+            discard_game_index(self.id)
+            self.discard_shared_state()
             
             # Obtener configuraciones de porcentaje
             percentage_settings = PercentageSettings.objects.first()
@@ -354,7 +538,7 @@ class Game(models.Model):
                     num_winners = len(winners)
                     
                     # Parte del premio que va a los jugadores (dividido entre ganadores)
-                    player_prize_per_winner = (self.current_prize * Decimal(percentage_settings.player_percentage / 100)) / num_winners
+                    player_prize_per_winner = (self.current_prize * Decimal(percentage_settings.player_percentage / 100) * self.final_stage_share()) / num_winners
                     
                     # Parte del organizador
                     organizer_prize = self.current_prize * Decimal(percentage_settings.organizer_percentage / 100)
@@ -489,16 +673,14 @@ class Game(models.Model):
 
         prize_increase = self.current_prize - old_prize
         
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
+        group_send_sync(
             f'game_{self.id}',
-            {
-                'type': 'prize_updated',
-                'new_prize': float(self.current_prize),
-                'increase_amount': float(prize_increase) if prize_increase > 0 else 0,
-                'total_cards': self.max_cards_sold,  # Mostramos el máximo
-                'next_target': self.next_prize_target
-            }
+            'prize_updated',
+            new_prize=float(self.current_prize),
+            increase_amount=float(prize_increase) if prize_increase > 0 else 0,
+            total_cards=self.max_cards_sold,  # Mostramos el máximo
+            next_target=self.next_prize_target,
+            progress_percentage=self.progress_percentage
         )
         
         return prize_increase
@@ -518,15 +700,45 @@ class Game(models.Model):
         
         super().save(*args, **kwargs)
 
+        from .snapshots import invalidate_on_commit
+        invalidate_on_commit(self.id)
+
 class Player(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
-    cards = models.JSONField(default=list)
     is_winner = models.BooleanField(default=False)
 
     def __str__(self):
         return f"{self.user.username} - {self.game.name}"
 
+    @property
+    def cards(self):
+        """Cartones del jugador como matrices 5x5 (cacheados en la instancia)"""
+        if getattr(self, '_cards_cache', None) is None:
+            self._cards_cache = [decode_card(card.numbers) for card in self.bingo_cards.all()]
+        return self._cards_cache
+
+    @property
+    def card_count(self):
+        if getattr(self, '_cards_cache', None) is not None:
+            return len(self._cards_cache)
+        return self.bingo_cards.count()
+
+    def take_card_from_pool(self):
+        """Asigna al jugador un cartón del pool pre-generado de la partida (lo recarga si se agota)"""
+        while True:
+            pool = Card.objects.filter(game_id=self.game_id, player__isnull=True).order_by('id')
+            card_id = pool.values_list('id', flat=True).first()
+            if card_id is None:
+                self.game.generate_card_pool()
+                continue
+            # Reclamar el cartón solo si nadie lo tomó entre la lectura y la escritura
+            if Card.objects.filter(id=card_id, player__isnull=True).update(player=self):
+                bingo_card = Card.objects.get(id=card_id)
+                if getattr(self, '_cards_cache', None) is not None:
+                    self._cards_cache.append(decode_card(bingo_card.numbers))
+                return bingo_card
+
     def generate_card(self):
         card = []
         for _ in range(5):
@@ -534,50 +746,51 @@ class Player(models.Model):
             card.append(row)
         return card
 
+    def compiled_cards(self):
+        """Cartones compilados a máscaras de bits (se recompilan solo si cambian)"""
+        cache = getattr(self, '_compiled_cards', None)
+        if cache is None or cache[0] != len(self.cards):
+            cache = (len(self.cards), [compile_card(card) for card in self.cards])
+            self._compiled_cards = cache
+        return cache[1]
+
     def check_bingo(self):
-        called_numbers_set = set(self.game.called_numbers)
-        
-        for card in self.cards:
-            # Función auxiliar para verificar si un número está marcado (considera 0 como comodín)
-            def is_marked(num):
-                return num == 0 or num in called_numbers_set
-            
-            if self.game.winning_pattern == 'HORIZONTAL':
-                for row in card:
-                    if all(is_marked(num) for num in row):
-                        return True
-            elif self.game.winning_pattern == 'VERTICAL':
-                for col in range(5):
-                    if all(is_marked(row[col]) for row in card):
-                        return True
-            elif self.game.winning_pattern == 'DIAGONAL':
-                if all(is_marked(card[i][i]) for i in range(5)) or \
-                all(is_marked(card[i][4-i]) for i in range(5)):
-                    return True
-            elif self.game.winning_pattern == 'FULL':
-                if all(is_marked(num) for row in card for num in row):
-                    return True
-            elif self.game.winning_pattern == 'CORNERS':
-                corners = [card[0][0], card[0][4], card[4][0], card[4][4]]
-                if all(is_marked(corner) for corner in corners):
-                    return True
-            elif self.game.winning_pattern == 'CUSTOM' and self.game.custom_pattern:
-                # Verificar patrón personalizado
-                pattern = self.game.custom_pattern
-                for i in range(5):
-                    for j in range(5):
-                        if pattern[i][j] == 1 and not is_marked(card[i][j]):
-                            break
-                    else:
-                        continue
-                    break
-                else:
-                    return True
+        pattern_masks = game_pattern_masks(self.game)
+        if not pattern_masks:
+            return False
+        called_mask = self.game.called_mask_int
+
+        for compiled in self.compiled_cards():
+            if is_winning_mask(marked_mask(compiled, called_mask), pattern_masks):
+                return True
         return False
 
     async def acheck_bingo(self):
         return await sync_to_async(self.check_bingo)()
 
+class Card(models.Model):
+    """
+    Cartón de bingo codificado en 25 bytes, fila por fila (0 = casilla libre).
+    Los cartones sin jugador forman el pool pre-generado de la partida.
+    """
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='bingo_cards')
+    player = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='bingo_cards', null=True, blank=True)
+    numbers = models.BinaryField(max_length=25)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['game', 'player'], name='card_game_player_idx'),
+        ]
+
+    def __str__(self):
+        return f"Cartón #{self.id} - {self.game_id}"
+
+    @property
+    def matrix(self):
+        return decode_card(self.numbers)
+
 class ChatMessage(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
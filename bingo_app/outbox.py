@@ -0,0 +1,84 @@
+"""
+Cola de salida acotada de cada conexión de BingoConsumer.
+
+Los handlers del grupo no escriben en el socket: encolan aquí y una sola
+tarea por conexión va enviando. Si el cliente va lento, los eventos se
+acumulan en esta cola (no en la capa de canales, que los descartaría al
+llenarse) y los que quedan superados se fusionan:
+
+- prize_updated y card_purchased: solo se conserva el último;
+- los number_called consecutivos se envían juntos (numbers_called en JSON
+  o varias tramas binarias en un mismo mensaje);
+- un game_status completo sustituye a los eventos anteriores que resume.
+
+Si aun así se superan BINGO_WS_OUTBOX_SIZE entradas, el cliente no da abasto:
+el consumer cierra la conexión con RESYNC_CLOSE_CODE y el cliente reanuda
+desde su último seq al reconectar.
+"""
+import asyncio
+import json
+from collections import deque
+
+from django.conf import settings
+
+
+RESYNC_CLOSE_CODE = 4000
+LATEST_ONLY = frozenset({'prize_updated', 'card_purchased'})
+SUPERSEDED_BY_STATUS = frozenset({'game_status', 'number_called', 'prize_updated', 'card_purchased'})
+
+
+class Outbox:
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = getattr(settings, 'BINGO_WS_OUTBOX_SIZE', 64)
+        self.max_size = max_size
+        self.entries = deque()
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, event_type, event):
+        """Encola un evento ({'text'} y opcionalmente 'bytes'); False si la cola está llena"""
+        entries = self.entries
+        if event_type == 'number_called' and entries and entries[-1][0] == 'number_called':
+            entries[-1][1].append(event)
+            return True
+        if event_type in LATEST_ONLY:
+            self._discard({event_type})
+        elif event_type == 'game_status':
+            self._discard(SUPERSEDED_BY_STATUS)
+        if len(entries) >= self.max_size:
+            return False
+        entries.append((event_type, [event]))
+        self.ready.set()
+        return True
+
+    def _discard(self, event_types):
+        # En el sitio: push sigue usando la misma deque
+        if any(event_type in event_types for event_type, _ in self.entries):
+            kept = [entry for entry in self.entries if entry[0] not in event_types]
+            self.entries.clear()
+            self.entries.extend(kept)
+
+    def clear(self):
+        self.entries.clear()
+
+    async def pop(self):
+        """Siguiente entrada a enviar: (tipo, [eventos])"""
+        while not self.entries:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.entries.popleft()
+
+
+def merged_numbers(events, binary):
+    """Un solo mensaje con varios number_called consecutivos: (texto, bytes)"""
+    if binary and all('bytes' in event for event in events):
+        return None, b''.join(event['bytes'] for event in events)
+    return json.dumps({
+        'type': 'numbers_called',
+        'numbers': [event['number'] for event in events],
+        'seq': events[-1]['seq'],
+    }), None
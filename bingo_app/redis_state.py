@@ -0,0 +1,245 @@
+"""
+Estado compartido de las partidas en Redis.
+
+Con varios workers, la vista call_number y el planificador pueden leer y
+reescribir la secuencia de números a la vez. Aquí cada partida vive en tres
+claves de Redis que solo se modifican mediante scripts Lua atómicos:
+
+    bingo:{game:<id>}:state   hash con el cursor de extracción, número actual,
+                              cartones vendidos y premio
+    bingo:{game:<id>}:called  bitmap con los números llamados
+    bingo:{game:<id>}:seq     números llamados en orden, un byte por número
+
+La base de datos sigue siendo el respaldo durable: las claves se cargan desde
+Game la primera vez que se usan y la secuencia que devuelven los scripts se
+vuelve a escribir en Game (Game.apply_called_sequence; por lotes en el
+planificador). El orden de extracción no se guarda: cada llamada lo envía
+derivado de draw_seed. Se activa con BINGO_REDIS_STATE y usa BINGO_REDIS_URL
+(REDIS_URL o un redis-server local).
+"""
+import threading
+
+import redis
+from django.conf import settings
+
+from .engine import draw_order
+
+
+CALL_NEXT_SCRIPT = """
+if KEYS[4] and redis.call('GET', KEYS[4]) ~= ARGV[3] then return -2 end
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local order = ARGV[2]
+local cursor = tonumber(redis.call('HGET', KEYS[1], 'cursor'))
+local number = 0
+while cursor < #order do
+    cursor = cursor + 1
+    local candidate = string.byte(order, cursor)
+    if redis.call('GETBIT', KEYS[2], candidate) == 0 then
+        number = candidate
+        break
+    end
+end
+redis.call('HSET', KEYS[1], 'cursor', cursor)
+if number > 0 then
+    redis.call('SETBIT', KEYS[2], number, 1)
+    redis.call('APPEND', KEYS[3], string.char(number))
+    redis.call('HSET', KEYS[1], 'current', number)
+end
+for i = 1, 3 do redis.call('EXPIRE', KEYS[i], ARGV[1]) end
+return {number, cursor, redis.call('GET', KEYS[3]) or ''}
+"""
+
+MANUAL_CALL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local number = tonumber(ARGV[1])
+if redis.call('GETBIT', KEYS[2], number) == 1 then
+    return {0, redis.call('GET', KEYS[3]) or ''}
+end
+redis.call('SETBIT', KEYS[2], number, 1)
+redis.call('APPEND', KEYS[3], string.char(number))
+redis.call('HSET', KEYS[1], 'current', number)
+for _, key in ipairs(KEYS) do redis.call('EXPIRE', key, ARGV[2]) end
+return {number, redis.call('GET', KEYS[3])}
+"""
+
+ADD_CARDS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local sold = redis.call('HINCRBY', KEYS[1], 'cards_sold', ARGV[1])
+local max_sold = tonumber(redis.call('HGET', KEYS[1], 'max_cards_sold') or 0)
+if sold > max_sold then
+    max_sold = sold
+    redis.call('HSET', KEYS[1], 'max_cards_sold', max_sold)
+end
+return {sold, max_sold}
+"""
+
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('DEL', KEYS[2], KEYS[3])
+redis.call('HSET', KEYS[1], 'cursor', ARGV[1], 'current', ARGV[3],
+           'cards_sold', ARGV[4], 'max_cards_sold', ARGV[5], 'prize', ARGV[6])
+for i = 1, #ARGV[2] do
+    redis.call('SETBIT', KEYS[2], string.byte(ARGV[2], i), 1)
+end
+if #ARGV[2] > 0 then redis.call('SET', KEYS[3], ARGV[2]) end
+for _, key in ipairs(KEYS) do redis.call('EXPIRE', key, ARGV[7]) end
+return 1
+"""
+
+_client = None
+_scripts = None
+_client_lock = threading.Lock()
+
+
+def enabled():
+    return getattr(settings, 'BINGO_REDIS_STATE', False)
+
+
+def get_redis():
+    global _client, _scripts
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                client = redis.Redis.from_url(getattr(settings, 'BINGO_REDIS_URL', 'redis://localhost:6379/0'))
+                _scripts = {
+                    'call_next': client.register_script(CALL_NEXT_SCRIPT),
+                    'manual_call': client.register_script(MANUAL_CALL_SCRIPT),
+                    'add_cards': client.register_script(ADD_CARDS_SCRIPT),
+                    'load': client.register_script(LOAD_SCRIPT),
+                }
+                _client = client
+    return _client
+
+
+def _script(name):
+    get_redis()
+    return _scripts[name]
+
+
+def state_ttl():
+    """Segundos que viven las claves de una partida desde su último cambio"""
+    return getattr(settings, 'BINGO_REDIS_STATE_TTL', 86400)
+
+
+def game_key(game_id, name):
+    """
+    Clave bingo:{game:<id>}:<name>. Todas las claves de una partida comparten
+    la etiqueta de hash, así los scripts que las combinan funcionan en cluster.
+    """
+    return f'bingo:{{game:{game_id}}}:{name}'
+
+
+def game_keys(game_id):
+    return [game_key(game_id, 'state'), game_key(game_id, 'called'), game_key(game_id, 'seq')]
+
+
+def lease_key(game_id):
+    """Concesión del planificador (leases.py)"""
+    return game_key(game_id, 'lease')
+
+
+def load_game(game, client=None):
+    """Copia el estado de un Game (o GameState) a Redis si aún no está cargado"""
+    sequence = bytes(game.sequence if hasattr(game, 'sequence') else game.called_sequence)
+    return _script('load')(
+        keys=game_keys(game.id),
+        args=[
+            game.draw_cursor, sequence, game.current_number or 0,
+            game.total_cards_sold, game.max_cards_sold, str(game.current_prize), state_ttl(),
+        ],
+        client=client,
+    )
+
+
+def _loaded(script, game, args, keys=None):
+    """Ejecuta un script cargando antes la partida si Redis no la tiene"""
+    keys = keys or game_keys(game.id)
+    result = _script(script)(keys=keys, args=args)
+    if result == -1:
+        load_game(game)
+        result = _script(script)(keys=keys, args=args)
+    return result
+
+
+def _draw_keys(game, lease_token):
+    keys = game_keys(game.id)
+    if lease_token is not None:
+        # Solo extrae quien tiene la concesión
+        keys.append(lease_key(game.id))
+    return keys
+
+
+def _draw_args(game, lease_token):
+    args = [state_ttl(), bytes(draw_order(game.draw_seed))]
+    if lease_token is not None:
+        args.append(lease_token)
+    return args
+
+
+def _draw_result(result):
+    if result == -2:
+        return None
+    number, cursor, sequence = result
+    return number or None, cursor, bytes(sequence)
+
+
+def call_next(game, lease_token=None):
+    """
+    Extrae la siguiente bola: (número o None, cursor, secuencia completa).
+    Con lease_token solo extrae si la concesión de la partida sigue siendo
+    de ese token; si no, devuelve None sin tocar el estado.
+    """
+    result = _loaded('call_next', game, _draw_args(game, lease_token), _draw_keys(game, lease_token))
+    return _draw_result(result)
+
+
+def call_next_many(games, lease_token=None):
+    """call_next para muchas partidas en un solo viaje a Redis"""
+    client = get_redis()
+    pipe = client.pipeline(transaction=False)
+    for game in games:
+        _script('call_next')(
+            keys=_draw_keys(game, lease_token), args=_draw_args(game, lease_token), client=pipe
+        )
+    results = pipe.execute()
+
+    missing = [game for game, result in zip(games, results) if result == -1]
+    if missing:
+        pipe = client.pipeline(transaction=False)
+        for game in missing:
+            load_game(game, client=pipe)
+        pipe.execute()
+        retried = iter(call_next(game, lease_token) for game in missing)
+    return [next(retried) if result == -1 else _draw_result(result) for result in results]
+
+
+def call_manual(game, number):
+    """Marca un número llamado a mano: (número o None si ya estaba, secuencia completa)"""
+    called, sequence = _loaded('manual_call', game, [number, state_ttl()])
+    return called or None, bytes(sequence)
+
+
+def add_cards_sold(game, count=1):
+    """Suma cartones vendidos de forma atómica: (total vendidos, máximo histórico)"""
+    sold, max_sold = _loaded('add_cards', game, [count])
+    return sold, max_sold
+
+
+def set_prize(game_id, prize):
+    get_redis().hset(game_keys(game_id)[0], 'prize', str(prize))
+
+
+def called_sequence(game_id):
+    """Secuencia de números llamados guardada en Redis, o None si la partida no está cargada"""
+    state_key, _, sequence_key = game_keys(game_id)
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.exists(state_key)
+    pipe.get(sequence_key)
+    exists, sequence = pipe.execute()
+    if not exists:
+        return None
+    return bytes(sequence or b'')
+
+
+def discard_game_state(game_id):
+    get_redis().delete(*game_keys(game_id))
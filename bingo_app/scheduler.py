@@ -0,0 +1,474 @@
+"""
+Planificador de llamadas automáticas.
+
+Un único servicio por proceso canta los números de todas las partidas con
+is_auto_calling=True, de modo que el avance de la partida no depende de qué
+socket del organizador sigue conectado y nunca hay dos bucles compitiendo por
+la misma partida. Se ejecuta como worker con `manage.py run_game_scheduler` o,
+si BINGO_SCHEDULER_EMBEDDED está activo, dentro del propio servidor ASGI.
+Con varios procesos, cada partida la canta solo el que tiene su concesión
+(leases.py).
+
+En lugar de una corrutina por partida, un solo bucle mantiene un heap con el
+próximo vencimiento de cada partida. En cada tick se sacan todas las
+partidas vencidas y se procesan juntas: las bolas se extraen sobre el estado
+en memoria de game_state.py (que con Redis se persiste por lotes con un
+retraso acotado) y los number_called se difunden en un único salto al bucle
+de eventos. El retraso de cada tick respecto al vencimiento se acumula en
+GameScheduler.stats.
+"""
+import asyncio
+import heapq
+import logging
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import event_log, redis_state, snapshots
+from .broadcast import group_send_sync, number_called_event
+from .game_state import STATE_FIELDS, game_states
+from .leases import get_lease_manager
+from .models import Game
+from .winners import find_stage_winner_ids, has_pending_winners, resolve_stages
+
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_CHANNEL = 'bingo-scheduler'
+TICK_CHUNK_SIZE = 500
+RECOVERY_CHUNK_SIZE = 1000
+
+
+def _active_games():
+    # Coincide con la condición del índice parcial game_auto_calling_idx
+    return Game.objects.filter(is_auto_calling=True, is_started=True, is_finished=False)
+
+
+def _recover_batch(after_id):
+    """Siguiente lote de partidas activas, sin cargarlas aún en game_states"""
+    return list(_active_games().filter(id__gt=after_id).order_by('id').only(*STATE_FIELDS)[:RECOVERY_CHUNK_SIZE])
+
+
+def _adopt(games):
+    # Solo las partidas con concesión: snapshots prefiere el estado en memoria
+    for game in games:
+        game_states.adopt(game)
+
+
+async def _broadcast(messages):
+    channel_layer = get_channel_layer()
+    await asyncio.gather(*(channel_layer.group_send(group, event) for group, event in messages))
+
+
+def _finish_game(game, winners, called_numbers):
+    game.refresh_from_db()
+    prize = float(game.current_prize) if game.current_prize else 0.0
+    # Paga a los ganadores de la etapa final que ya resolvió resolve_stages
+    # (end_game los recalcularía sobre current_stage, que puede ser una etapa sin ganador)
+    game.end_game_manual([player.user for player in winners])
+    group_send_sync(
+        f'game_{game.id}',
+        'game_ended',
+        winner=winners[0].user.username,
+        prize=prize,
+        called_numbers=called_numbers
+    )
+
+
+def _stop_exhausted_game(game_id):
+    # Ya no quedan bolas: detener la llamada automática
+    game_states.evict(game_id)
+    game = Game.objects.get(id=game_id)
+    game.stop_auto_calling()
+    group_send_sync(f'game_{game_id}', 'auto_call_toggled', is_auto_calling=False)
+
+
+def _resolve_winners(state):
+    """
+    Verifica ganadores sobre el estado en memoria y solo pasa por la base de
+    datos cuando alguna etapa tiene ganadores. Devuelve True si la partida
+    debe seguir llamando números.
+    """
+    if not has_pending_winners(state, find_stage_winner_ids(state)):
+        return True
+
+    # Hay premios que pagar: persistir el estado y continuar sobre el modelo
+    game_states.evict(state.id)
+    game = Game.objects.get(id=state.id)
+    winners = resolve_stages(game)
+    if winners:
+        _finish_game(game, winners, game.called_numbers)
+        return False
+    return True
+
+
+def call_next_balls(game_ids, lease_token=None):
+    """
+    Canta la siguiente bola de cada partida indicada y difunde los eventos.
+    Las bolas se extraen sobre el estado en memoria (game_states); con Redis
+    se persisten más tarde por lotes y solo si lease_token sigue teniendo la
+    concesión de la partida. Devuelve {game_id: intervalo hasta la próxima
+    bola}; las partidas que ya no deben seguir llamando números (o que ya no
+    son de este proceso) no aparecen en el resultado.
+    """
+    intervals = {}
+    for start in range(0, len(game_ids), TICK_CHUNK_SIZE):
+        running = []
+        for state in game_states.get_many(game_ids[start:start + TICK_CHUNK_SIZE]):
+            if state.is_running:
+                running.append(state)
+            else:
+                game_states.evict(state.id)
+
+        if redis_state.enabled():
+            # Extracción atómica en Redis, compartida con los demás workers
+            fenced, numbers = [], []
+            for state, draw in zip(running, redis_state.call_next_many(running, lease_token)):
+                if draw is None:
+                    # Otro worker tomó la concesión durante el tick: ya no la cantamos
+                    logger.warning("Concesión perdida al extraer en la partida %s", state.id)
+                    game_states.evict(state.id)
+                    continue
+                number, cursor, sequence = draw
+                state.apply_draw(cursor, sequence)
+                fenced.append(state)
+                numbers.append(number)
+            running = fenced
+        else:
+            # Sin Redis la base de datos se actualiza antes de difundir
+            numbers = game_states.draw_locked(running) if running else []
+
+        drawn = []
+        for state, number in zip(running, numbers):
+            if number is None:
+                _stop_exhausted_game(state.id)
+            else:
+                if redis_state.enabled():
+                    game_states.mark_dirty(state.id)
+                drawn.append((state, number))
+        if not drawn:
+            continue
+
+        events = [
+            (state.id, state.called_count, number_called_event(number, state.called_count))
+            for state, number in drawn
+        ]
+        snapshots.invalidate(state.id for state, _ in drawn)
+        event_log.record_many([(game_id, seq, event['text']) for game_id, seq, event in events])
+        async_to_sync(_broadcast)([(f'game_{game_id}', event) for game_id, _, event in events])
+
+        for state, _ in drawn:
+            try:
+                if not _resolve_winners(state):
+                    continue
+            except Exception:
+                logger.exception("Error verificando ganadores en la partida %s", state.id)
+            intervals[state.id] = state.auto_call_interval
+    return intervals
+
+
+class GameScheduler:
+    """Canta los números de todas las partidas activas de este proceso desde un solo bucle"""
+
+    def __init__(self, reconcile_interval=None, drift_warning=None, leases=None):
+        if reconcile_interval is None:
+            reconcile_interval = getattr(settings, 'BINGO_SCHEDULER_RECONCILE_INTERVAL', 5)
+        if drift_warning is None:
+            drift_warning = getattr(settings, 'BINGO_SCHEDULER_DRIFT_WARNING', 1.0)
+        self.reconcile_interval = reconcile_interval
+        self.drift_warning = drift_warning
+        self.heartbeat_interval = getattr(settings, 'BINGO_LEASE_HEARTBEAT', 0.5)
+        self.leases = leases or get_lease_manager()
+        self.active_ids = set()  # partidas activas según la última reconciliación
+        self.owned = set()  # partidas cuya concesión tiene este proceso
+        self.heap = []  # (vencimiento, game_id)
+        self.due = {}  # game_id -> vencimiento vigente (las entradas del heap que no coinciden se ignoran)
+        self.stats = {
+            'ticks': 0, 'balls': 0, 'max_drift': 0.0, 'avg_drift': 0.0, 'last_tick_seconds': 0.0,
+            'leases_acquired': 0, 'leases_lost': 0,
+        }
+        self._wake = asyncio.Event()
+        self._runner = None
+
+    def __len__(self):
+        return len(self.due)
+
+    def wake(self):
+        """Pide una reconciliación inmediata con la base de datos"""
+        self._wake.set()
+
+    def ensure_started(self):
+        """Arranca el planificador en el bucle de eventos actual si no está corriendo"""
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.get_running_loop().create_task(self.run())
+
+    def schedule(self, game_id, when):
+        self.due[game_id] = when
+        heapq.heappush(self.heap, (when, game_id))
+
+    def unschedule(self, game_id):
+        self.due.pop(game_id, None)
+
+    def pop_due(self, now):
+        """Saca del heap las partidas vencidas: [(game_id, vencimiento)]"""
+        ready = []
+        while self.heap and self.heap[0][0] <= now:
+            when, game_id = heapq.heappop(self.heap)
+            if self.due.get(game_id) == when:
+                del self.due[game_id]
+                ready.append((game_id, when))
+        return ready
+
+    def next_due(self):
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    @database_sync_to_async
+    def _active_game_ids(self):
+        sequences = dict(_active_games().values_list('id', 'called_sequence'))
+        # Números llamados a mano desde otro proceso
+        game_states.merge_persisted(sequences)
+        for game_id in list(game_states.states):
+            if game_id not in sequences:
+                game_states.evict(game_id)
+        return set(sequences)
+
+    async def recover(self, budget=None):
+        """
+        Al arrancar, retoma las partidas que la base de datos da por activas
+        desde su estado guardado, por lotes y dentro de un presupuesto de
+        tiempo (BINGO_RECOVERY_BUDGET). Las que no quepan las recoge la
+        reconciliación normal. Devuelve True si se recorrieron todas.
+        """
+        if budget is None:
+            budget = getattr(settings, 'BINGO_RECOVERY_BUDGET', 10.0)
+        started = time.monotonic()
+        last_id = 0
+        recovered = 0
+        complete = False
+        while time.monotonic() - started < budget:
+            batch = await database_sync_to_async(_recover_batch)(last_id)
+            if not batch:
+                complete = True
+                break
+            last_id = batch[-1].id
+            game_ids = {game.id for game in batch}
+            self.active_ids |= game_ids
+            acquired = await sync_to_async(self.leases.acquire)(game_ids - self.owned)
+            await database_sync_to_async(_adopt)([game for game in batch if game.id in acquired])
+            now = time.monotonic()
+            for game in batch:
+                if game.id in acquired:
+                    # Repartir la primera bola dentro del intervalo para no cantar todas a la vez
+                    self.schedule(game.id, now + game.auto_call_interval * (game.id % 10) / 10)
+            self.owned |= acquired
+            recovered += len(acquired)
+
+        elapsed = time.monotonic() - started
+        self.stats.update({
+            'recovered_games': recovered,
+            'recovery_seconds': elapsed,
+            'recovery_complete': complete,
+        })
+        self.stats['leases_acquired'] += recovered
+        logger.info(
+            "Recuperadas %s partidas en %.2fs%s", recovered, elapsed,
+            "" if complete else " (presupuesto agotado, el resto se recoge al reconciliar)"
+        )
+        return complete
+
+    async def reconcile(self):
+        self.active_ids = await self._active_game_ids()
+        await self.heartbeat()
+
+    async def heartbeat(self):
+        """
+        Renueva las concesiones propias, suelta las de partidas que ya no
+        están activas y adquiere las libres (las de un worker caído caducan y
+        se toman aquí). Solo se programan las partidas concedidas.
+        """
+        held = await sync_to_async(self.leases.renew)(self.owned)
+        for game_id in self.owned - held:
+            logger.warning("Se perdió la concesión de la partida %s", game_id)
+            self.stats['leases_lost'] += 1
+            self.unschedule(game_id)
+            await database_sync_to_async(game_states.evict)(game_id)
+
+        finished = held - self.active_ids
+        if finished:
+            await sync_to_async(self.leases.release)(finished)
+            for game_id in finished:
+                self.unschedule(game_id)
+
+        acquired = await sync_to_async(self.leases.acquire)(self.active_ids - held)
+        now = time.monotonic()
+        for game_id in acquired:
+            self.schedule(game_id, now)
+        self.stats['leases_acquired'] += len(acquired)
+        self.owned = (held - finished) | acquired
+
+    def _record_drift(self, ready, started, finished):
+        drifts = [started - when for _, when in ready]
+        stats = self.stats
+        stats['ticks'] += 1
+        stats['balls'] += len(ready)
+        stats['last_tick_seconds'] = finished - started
+        tick_drift = max(drifts)
+        stats['max_drift'] = max(stats['max_drift'], tick_drift)
+        # Media móvil exponencial del retraso medio por tick
+        stats['avg_drift'] += 0.1 * (sum(drifts) / len(drifts) - stats['avg_drift'])
+        if tick_drift > self.drift_warning:
+            logger.warning(
+                "Tick con %s partidas retrasado %.3fs (procesado en %.3fs)",
+                len(ready), tick_drift, finished - started
+            )
+
+    async def tick(self, now):
+        ready = self.pop_due(now)
+        if not ready:
+            return
+        try:
+            intervals = await database_sync_to_async(call_next_balls)(
+                [game_id for game_id, _ in ready], self.leases.token
+            )
+        except Exception:
+            logger.exception("Error en el tick de %s partidas", len(ready))
+            intervals = {game_id: self.reconcile_interval for game_id, _ in ready}
+        finished = time.monotonic()
+        self._record_drift(ready, now, finished)
+
+        for game_id, when in ready:
+            interval = intervals.get(game_id)
+            if interval is None:
+                continue
+            # Mantener la cadencia sin acumular el retraso del tick
+            self.schedule(game_id, max(when + interval, finished))
+
+    async def flush(self):
+        try:
+            await database_sync_to_async(game_states.flush)()
+        except Exception:
+            logger.exception("Error guardando el estado de las partidas")
+
+    async def _listen(self):
+        """Despierta al planificador con los avisos enviados por notify_scheduler"""
+        channel_layer = get_channel_layer()
+        while True:
+            await channel_layer.receive(SCHEDULER_CHANNEL)
+            self.wake()
+
+    async def run(self, listen=False):
+        listener = asyncio.create_task(self._listen()) if listen else None
+        next_reconcile = 0.0
+        next_heartbeat = 0.0
+        try:
+            try:
+                if await self.recover():
+                    next_reconcile = time.monotonic() + self.reconcile_interval
+                next_heartbeat = time.monotonic() + self.heartbeat_interval
+            except Exception:
+                logger.exception("Error recuperando partidas al arrancar")
+
+            while True:
+                now = time.monotonic()
+                if now >= next_reconcile or self._wake.is_set():
+                    self._wake.clear()
+                    try:
+                        await self.reconcile()
+                    except Exception:
+                        logger.exception("Error reconciliando partidas automáticas")
+                    now = time.monotonic()
+                    next_reconcile = now + self.reconcile_interval
+                    next_heartbeat = now + self.heartbeat_interval
+                elif now >= next_heartbeat:
+                    try:
+                        await self.heartbeat()
+                    except Exception:
+                        logger.exception("Error renovando las concesiones de partidas")
+                    now = time.monotonic()
+                    next_heartbeat = now + self.heartbeat_interval
+
+                await self.tick(now)
+
+                flush_due = game_states.flush_due()
+                if flush_due is not None and flush_due <= time.monotonic():
+                    await self.flush()
+
+                deadline = min(next_reconcile, next_heartbeat)
+                for due in (self.next_due(), game_states.flush_due()):
+                    if due is not None:
+                        deadline = min(deadline, due)
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    # Ceder el bucle aunque haya partidas vencidas
+                    await asyncio.sleep(0)
+                    continue
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if listener:
+                listener.cancel()
+            self.heap.clear()
+            self.due.clear()
+            await self.flush()
+            # Soltar las concesiones para que otro worker retome las partidas al instante
+            try:
+                await sync_to_async(self.leases.release)(self.owned)
+            except Exception:
+                logger.exception("Error liberando las concesiones de partidas")
+            self.owned = set()
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = GameScheduler()
+    return _scheduler
+
+
+class SchedulerStartupMiddleware:
+    """
+    Arranca el planificador embebido con el servidor ASGI: en el evento
+    lifespan de startup si el servidor lo envía, o con la primera conexión
+    (HTTP o WebSocket) en servidores que no lo soportan, como daphne.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    get_scheduler().ensure_started()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        get_scheduler().ensure_started()
+        return await self.app(scope, receive, send)
+
+
+async def notify_scheduler(game_id=None):
+    """Avisa al planificador de que una partida empezó o dejó de llamar automáticamente"""
+    if getattr(settings, 'BINGO_SCHEDULER_EMBEDDED', True):
+        scheduler = get_scheduler()
+        scheduler.ensure_started()
+        scheduler.wake()
+        return
+    try:
+        await get_channel_layer().send(SCHEDULER_CHANNEL, {'type': 'scheduler.wake', 'game_id': game_id})
+    except ChannelFull:
+        # Hay avisos pendientes: el planificador reconciliará igualmente
+        pass
@@ -0,0 +1,166 @@
+"""
+Instantáneas versionadas del game_status que se envía al conectar.
+
+Cada partida tiene un número de versión que se incrementa cuando cambia
+(Game.save y cada bola del planificador llaman a invalidate). La instantánea
+guarda el mensaje game_status ya serializado junto con los datos que el
+consumer necesita al conectar (organizador y banderas), y se reconstruye
+solo cuando su versión no coincide con la actual. Así una avalancha de
+conexiones al empezar la partida cuesta una consulta, no dos por socket.
+resume_text es el mismo mensaje sin called_numbers, para los clientes que
+reanudan con los eventos de event_log.
+
+Con BINGO_REDIS_STATE la versión y la instantánea viven en Redis
+(bingo:{game:<id>}:version y :snapshot) y se comparten entre workers; cada
+proceso guarda además la última copia que ha leído. Sin Redis las versiones
+son locales al proceso.
+"""
+import json
+import threading
+from collections import namedtuple
+
+from django.db import transaction
+
+from . import redis_state
+from .game_state import game_states
+from .models import Game
+
+
+Snapshot = namedtuple('Snapshot', 'version organizer_id is_auto_calling is_finished seq text resume_text')
+
+SNAPSHOT_FIELDS = (
+    'id', 'organizer', 'is_started', 'is_finished', 'is_auto_calling',
+    'current_number', 'called_mask', 'called_sequence', 'current_prize',
+    'total_cards_sold', 'next_prize_target',
+)
+LOCAL_CACHE_SIZE = 10000
+
+_local = {}
+_local_versions = {}
+_lock = threading.Lock()
+
+
+def version_key(game_id):
+    return redis_state.game_key(game_id, 'version')
+
+
+def snapshot_key(game_id):
+    return redis_state.game_key(game_id, 'snapshot')
+
+
+def invalidate(game_ids):
+    """Incrementa la versión de las partidas indicadas"""
+    game_ids = list(game_ids)
+    if not game_ids:
+        return
+    if redis_state.enabled():
+        pipe = redis_state.get_redis().pipeline(transaction=False)
+        for game_id in game_ids:
+            pipe.incr(version_key(game_id))
+            pipe.expire(version_key(game_id), redis_state.state_ttl())
+        pipe.execute()
+    else:
+        with _lock:
+            for game_id in game_ids:
+                _local_versions[game_id] = _local_versions.get(game_id, 0) + 1
+
+
+def invalidate_on_commit(game_id):
+    # Tras el commit, para que la reconstrucción no lea la fila anterior
+    transaction.on_commit(lambda: invalidate([game_id]))
+
+
+def _game_status(game):
+    state = game_states.peek(game.id)
+    if state is not None:
+        # Si el planificador corre en este proceso, el estado en memoria es el más reciente
+        return state.status()
+    if redis_state.enabled():
+        # La base de datos puede ir por detrás de la secuencia compartida
+        sequence = redis_state.called_sequence(game.id)
+        if sequence is not None:
+            game.apply_called_sequence(sequence)
+    return {
+        'is_started': game.is_started,
+        'is_finished': game.is_finished,
+        'is_auto_calling': game.is_auto_calling,
+        'current_number': game.current_number,
+        'called_numbers': game.called_numbers,
+        'current_prize': game.current_prize,
+        'total_cards_sold': game.total_cards_sold,
+        'next_prize_target': game.next_prize_target,
+        'progress_percentage': game.progress_percentage
+    }
+
+
+def _build(game_id, version):
+    game = Game.objects.filter(id=game_id).only(*SNAPSHOT_FIELDS).first()
+    if game is None:
+        return None
+    status = _game_status(game)
+    status['seq'] = len(status['called_numbers'])
+    if status['current_prize'] is not None:
+        status['current_prize'] = float(status['current_prize'])
+    text = json.dumps({'type': 'game_status', **status})
+    del status['called_numbers']
+    return Snapshot(
+        version, game.organizer_id, status['is_auto_calling'], status['is_finished'],
+        status['seq'], text, json.dumps({'type': 'game_status', **status}),
+    )
+
+
+def _remember(game_id, snapshot):
+    if len(_local) >= LOCAL_CACHE_SIZE:
+        _local.clear()
+    _local[game_id] = snapshot
+    return snapshot
+
+
+def _from_redis(game_id):
+    client = redis_state.get_redis()
+    pipe = client.pipeline(transaction=False)
+    pipe.get(version_key(game_id))
+    pipe.hgetall(snapshot_key(game_id))
+    version, stored = pipe.execute()
+    version = int(version or 0)
+
+    local = _local.get(game_id)
+    if local is not None and local.version == version:
+        return local
+    if stored and int(stored[b'version']) == version:
+        return _remember(game_id, Snapshot(
+            version, int(stored[b'organizer_id']), stored[b'is_auto_calling'] == b'1',
+            stored[b'is_finished'] == b'1', int(stored[b'seq']),
+            stored[b'text'].decode(), stored[b'resume_text'].decode(),
+        ))
+
+    snapshot = _build(game_id, version)
+    if snapshot is None:
+        return None
+    pipe = client.pipeline(transaction=False)
+    pipe.hset(snapshot_key(game_id), mapping={
+        'version': version,
+        'organizer_id': snapshot.organizer_id,
+        'is_auto_calling': int(snapshot.is_auto_calling),
+        'is_finished': int(snapshot.is_finished),
+        'seq': snapshot.seq,
+        'text': snapshot.text,
+        'resume_text': snapshot.resume_text,
+    })
+    pipe.expire(snapshot_key(game_id), redis_state.state_ttl())
+    pipe.execute()
+    return _remember(game_id, snapshot)
+
+
+def get_snapshot(game_id):
+    """Instantánea vigente de la partida, o None si no existe"""
+    game_id = int(game_id)
+    if redis_state.enabled():
+        return _from_redis(game_id)
+
+    version = _local_versions.get(game_id, 0)
+    local = _local.get(game_id)
+    if local is not None and local.version == version:
+        return local
+    snapshot = _build(game_id, version)
+    return _remember(game_id, snapshot) if snapshot is not None else None
@@ -1,3 +1,425 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+from decimal import Decimal
+from unittest import SkipTest
 
-# Create your tests here.
+import numpy as np
+import redis
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from . import event_log, redis_state
+from .engine import (
+    GameCardArray, GameCardIndex, compile_card, compile_pattern, compile_stages, decode_card, draw_order,
+    encode_card, generate_unique_cards, is_winning_mask, marked_mask,
+)
+from .forms import GameForm
+from .game_state import GameState, GameStateStore
+from .models import Card, Game, PercentageSettings, Player, Transaction, User
+from .outbox import Outbox, merged_numbers
+from .scheduler import _resolve_winners
+
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+CARD = [
+    [1, 16, 31, 46, 61],
+    [2, 17, 32, 47, 62],
+    [3, 18, 0, 48, 63],
+    [4, 19, 33, 49, 64],
+    [5, 20, 34, 50, 65],
+]
+TOP_ROW = CARD[0]
+CORNERS = [1, 61, 5, 65]
+
+
+def reference_check_bingo(card, called, winning_pattern, custom_pattern=None):
+    """check_bingo original, casilla por casilla, para contrastar los motores"""
+    def is_marked(num):
+        return num == 0 or num in called
+
+    if winning_pattern == 'HORIZONTAL':
+        return any(all(is_marked(num) for num in row) for row in card)
+    if winning_pattern == 'VERTICAL':
+        return any(all(is_marked(row[col]) for row in card) for col in range(5))
+    if winning_pattern == 'DIAGONAL':
+        return all(is_marked(card[i][i]) for i in range(5)) or all(is_marked(card[i][4 - i]) for i in range(5))
+    if winning_pattern == 'FULL':
+        return all(is_marked(num) for row in card for num in row)
+    if winning_pattern == 'CORNERS':
+        return all(is_marked(card[i][j]) for i in (0, 4) for j in (0, 4))
+    if winning_pattern == 'CUSTOM':
+        return all(is_marked(card[i][j]) for i in range(5) for j in range(5) if custom_pattern[i][j] == 1)
+    return False
+
+
+class WinnerEngineTests(SimpleTestCase):
+    """Máscaras de bits, índice invertido y numpy frente al check_bingo original"""
+
+    PATTERNS = (
+        ('HORIZONTAL', None), ('VERTICAL', None), ('DIAGONAL', None), ('FULL', None), ('CORNERS', None),
+        ('CUSTOM', [[1, 0, 0, 0, 1], [0, 1, 0, 1, 0], [0, 0, 1, 0, 0], [0, 1, 0, 1, 0], [1, 0, 0, 0, 1]]),
+    )
+
+    def test_engines_match_reference(self):
+        rng = random.Random(7)
+        cards = [decode_card(data) for data in generate_unique_cards(300, rng=np.random.default_rng(7))]
+        for pattern, custom in self.PATTERNS:
+            stages = compile_stages([(pattern, 1)], custom)
+            index = GameCardIndex(stages)
+            array_engine = GameCardArray(stages)
+            for card_id, card in enumerate(cards):
+                index.add_card(card_id, card_id, encode_card(card))
+                array_engine.add_card(card_id, card_id, encode_card(card))
+            compiled = [compile_card(card) for card in cards]
+            masks = compile_pattern(pattern, custom)
+
+            order = list(draw_order(rng.getrandbits(63)))
+            for count in (0, 5, 12, 20, 30, 45, 60, 75):
+                called = order[:count]
+                called_set = set(called)
+                expected = {
+                    card_id for card_id, card in enumerate(cards)
+                    if reference_check_bingo(card, called_set, pattern, custom)
+                }
+                called_mask = sum(1 << number for number in called)
+                bitmask = {
+                    card_id for card_id, card in enumerate(compiled)
+                    if is_winning_mask(marked_mask(card, called_mask), masks)
+                }
+                with self.subTest(pattern=pattern, called=count):
+                    self.assertEqual(bitmask, expected)
+                    # El índice se sincroniza de forma incremental entre prefijos
+                    self.assertEqual(index.sync(called)[0], expected)
+                    self.assertEqual(array_engine.sync(called)[0], expected)
+
+    def test_multi_line_stages(self):
+        stages = compile_stages([('HORIZONTAL', 2), ('FULL', 1)])
+        index = GameCardIndex(stages)
+        array_engine = GameCardArray(stages)
+        for engine in (index, array_engine):
+            engine.add_card(1, 1, encode_card(CARD))
+
+        for engine in (index, array_engine):
+            self.assertEqual(engine.sync(CARD[0]), (set(), set()))
+            self.assertEqual(engine.sync(CARD[0] + CARD[1]), ({1}, set()))
+            every_number = [num for row in CARD for num in row if num]
+            self.assertEqual(engine.sync(every_number), ({1}, {1}))
+
+
+class OutboxTests(SimpleTestCase):
+
+    def event(self, seq):
+        return {'text': f'{{"seq": {seq}}}', 'number': seq, 'seq': seq}
+
+    def test_consecutive_numbers_are_merged(self):
+        outbox = Outbox(max_size=10)
+        for seq in (1, 2, 3):
+            self.assertTrue(outbox.push('number_called', self.event(seq)))
+        outbox.push('chat_batch', {'text': 'chat'})
+        outbox.push('number_called', self.event(4))
+
+        self.assertEqual(len(outbox), 3)
+        event_type, events = asyncio.run(outbox.pop())
+        self.assertEqual(event_type, 'number_called')
+        text, data = merged_numbers(events, binary=False)
+        self.assertIsNone(data)
+        self.assertEqual(json.loads(text), {'type': 'numbers_called', 'numbers': [1, 2, 3], 'seq': 3})
+
+    def test_latest_only_events_replace_older_ones(self):
+        outbox = Outbox(max_size=10)
+        outbox.push('prize_updated', {'text': 'a'})
+        outbox.push('chat_batch', {'text': 'chat'})
+        outbox.push('prize_updated', {'text': 'b'})
+        self.assertEqual([(event_type, events[0]['text']) for event_type, events in outbox.entries], [
+            ('chat_batch', 'chat'), ('prize_updated', 'b'),
+        ])
+
+    def test_game_status_supersedes_what_it_summarises(self):
+        outbox = Outbox(max_size=10)
+        outbox.push('number_called', self.event(1))
+        outbox.push('card_purchased', {'text': 'card'})
+        outbox.push('chat_batch', {'text': 'chat'})
+        outbox.push('game_status', {'text': 'status'})
+        self.assertEqual([event_type for event_type, _ in outbox.entries], ['chat_batch', 'game_status'])
+
+    def test_overflow(self):
+        outbox = Outbox(max_size=2)
+        self.assertTrue(outbox.push('chat_batch', {'text': '1'}))
+        self.assertTrue(outbox.push('stage_won', {'text': '2'}))
+        self.assertFalse(outbox.push('chat_batch', {'text': '3'}))
+        self.assertFalse(outbox.push('number_called', self.event(1)))
+
+        # Un number_called que se fusiona con el último sigue cabiendo
+        outbox = Outbox(max_size=1)
+        self.assertTrue(outbox.push('number_called', self.event(1)))
+        self.assertTrue(outbox.push('number_called', self.event(2)))
+        outbox.clear()
+        self.assertEqual(len(outbox), 0)
+
+    def test_binary_frames_are_concatenated(self):
+        events = [{'text': 't', 'bytes': b'\x01\x00\x01\x05'}, {'text': 't', 'bytes': b'\x01\x00\x02\x07'}]
+        self.assertEqual(merged_numbers(events, binary=True), (None, b'\x01\x00\x01\x05\x01\x00\x02\x07'))
+
+
+@override_settings(BINGO_REDIS_STATE=False, BINGO_EVENT_BUFFER_SIZE=5)
+class EventLogTests(SimpleTestCase):
+    GAME_ID = 10 ** 9
+
+    def setUp(self):
+        event_log._local.pop(self.GAME_ID, None)
+        self.addCleanup(event_log._local.pop, self.GAME_ID, None)
+        event_log.record_many([(self.GAME_ID, seq, f'ev{seq}') for seq in range(1, 9)])
+
+    def test_returns_events_after_last_seq(self):
+        self.assertEqual(event_log.missed_events(self.GAME_ID, 5, 8), ['ev6', 'ev7', 'ev8'])
+        self.assertEqual(event_log.missed_events(self.GAME_ID, 3, 8), ['ev4', 'ev5', 'ev6', 'ev7', 'ev8'])
+
+    def test_up_to_date(self):
+        self.assertEqual(event_log.missed_events(self.GAME_ID, 8, 8), [])
+
+    def test_gap_older_than_buffer_needs_snapshot(self):
+        self.assertIsNone(event_log.missed_events(self.GAME_ID, 2, 8))
+
+    def test_client_ahead_of_server_needs_snapshot(self):
+        self.assertIsNone(event_log.missed_events(self.GAME_ID, 9, 8))
+
+    def test_missing_buffer_needs_snapshot(self):
+        self.assertIsNone(event_log.missed_events(self.GAME_ID + 1, 0, 3))
+        self.assertEqual(event_log.missed_events(self.GAME_ID + 1, 0, 0), [])
+
+
+@override_settings(BINGO_REDIS_STATE=False)
+class DrawLockedTests(TestCase):
+
+    def setUp(self):
+        organizer = User.objects.create(username='organizador', is_organizer=True)
+        self.game = Game.objects.create(
+            name='Partida', organizer=organizer, base_prize=100, is_started=True, is_auto_calling=True, draw_seed=42,
+        )
+        self.store = GameStateStore()
+        self.state = self.store.get(self.game.id)
+
+    def test_draws_are_persisted_immediately(self):
+        numbers = [self.store.draw_locked([self.state])[0] for _ in range(3)]
+        self.assertEqual(numbers, list(draw_order(42)[:3]))
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.called_numbers, numbers)
+        self.assertEqual(self.game.draw_cursor, 3)
+        self.assertFalse(self.state.is_dirty)
+
+    def test_manual_call_from_another_process_is_merged(self):
+        first = self.store.draw_locked([self.state])[0]
+        order = draw_order(42)
+        # Otro proceso llama a mano la bola que tocaba a continuación
+        game = Game.objects.get(id=self.game.id)
+        game.register_called_number(order[1])
+
+        drawn = self.store.draw_locked([self.state])[0]
+        self.assertEqual(drawn, order[2])
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.called_numbers, [first, order[1], order[2]])
+        self.assertEqual(self.state.called_numbers, self.game.called_numbers)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, BINGO_REDIS_STATE=False)
+class StageResolutionTests(TestCase):
+    """Pago de etapas y fin de partida tal como lo hace el planificador"""
+
+    def setUp(self):
+        PercentageSettings.objects.create()
+        organizer = User.objects.create(username='organizador', is_organizer=True)
+        self.user = User.objects.create(username='jugador')
+        self.game = Game.objects.create(
+            name='Partida', organizer=organizer, winning_pattern='HORIZONTAL', base_prize=100,
+            is_started=True, is_auto_calling=True, draw_seed=1,
+            prize_stages=[{'pattern': 'CORNERS', 'lines': 1, 'percentage': 20}],
+        )
+        self.player = Player.objects.create(user=self.user, game=self.game)
+        Card.objects.create(game=self.game, player=self.player, numbers=encode_card(CARD))
+        self.game.total_cards_sold = 1
+        self.game.save()
+
+    def call(self, numbers):
+        self.game.refresh_from_db()
+        self.game.apply_called_sequence(bytes(self.game.called_numbers + numbers))
+        self.game.save()
+        return _resolve_winners(GameState.from_game(self.game))
+
+    def test_final_stage_pays_when_intermediate_stage_is_unwon(self):
+        # La fila superior completa la etapa final sin completar las esquinas
+        self.assertFalse(self.call(TOP_ROW))
+
+        self.game.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertTrue(self.game.is_finished)
+        self.assertEqual(self.game.current_stage, 0)
+        # La parte de la etapa sin ganador pasa al premio final: 70% de 100
+        self.assertEqual(self.user.credit_balance, Decimal('70.00'))
+        self.assertEqual(Transaction.objects.filter(user=self.user, transaction_type='PRIZE').count(), 1)
+        self.assertTrue(Player.objects.get(id=self.player.id).is_winner)
+
+    def test_intermediate_stage_then_final(self):
+        # Las esquinas pagan su 20% y la partida sigue
+        self.assertTrue(self.call(CORNERS))
+        self.game.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual(self.game.current_stage, 1)
+        self.assertFalse(self.game.is_finished)
+        self.assertEqual(self.user.credit_balance, Decimal('14.00'))
+
+        self.assertFalse(self.call([16, 31, 46]))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credit_balance, Decimal('14.00') + Decimal('56.00'))
+        self.assertEqual(Transaction.objects.filter(user=self.user, transaction_type='PRIZE').count(), 2)
+
+    def test_no_winner_keeps_calling(self):
+        self.assertTrue(self.call([2, 17]))
+        self.game.refresh_from_db()
+        self.assertFalse(self.game.is_finished)
+
+
+@override_settings(BINGO_REDIS_STATE=True)
+class RedisStateTests(TestCase):
+    """
+    Scripts Lua de redis_state.py contra un redis-server local
+    (BINGO_REDIS_URL); se omiten si no hay servidor disponible.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            redis_state.get_redis().ping()
+        except redis.ConnectionError:
+            raise SkipTest("No hay un redis-server disponible en BINGO_REDIS_URL")
+        super().setUpClass()
+
+    def setUp(self):
+        organizer = User.objects.create(username='organizador', is_organizer=True)
+        self.game = Game.objects.create(
+            name='Partida', organizer=organizer, base_prize=100, is_started=True, draw_seed=1234,
+        )
+        self.order = draw_order(self.game.draw_seed)
+        self.addCleanup(redis_state.discard_game_state, self.game.id)
+        redis_state.discard_game_state(self.game.id)
+
+    def set_called(self, numbers, cursor=0):
+        self.game.apply_called_sequence(bytes(numbers))
+        self.game.draw_cursor = cursor
+
+    def test_load_copies_game_once(self):
+        self.set_called([5, 9], cursor=3)
+        self.game.total_cards_sold = 7
+        self.game.max_cards_sold = 10
+
+        self.assertEqual(redis_state.load_game(self.game), 1)
+        self.assertEqual(redis_state.called_sequence(self.game.id), bytes([5, 9]))
+        state_key, called_key, _ = redis_state.game_keys(self.game.id)
+        client = redis_state.get_redis()
+        self.assertEqual(client.hget(state_key, 'cursor'), b'3')
+        self.assertEqual(client.hget(state_key, 'cards_sold'), b'7')
+        self.assertEqual(client.getbit(called_key, 9), 1)
+        self.assertEqual(client.getbit(called_key, 10), 0)
+
+        # Ya cargada: no se pisa el estado de Redis con el de la base de datos
+        self.set_called([5, 9, 11])
+        self.assertEqual(redis_state.load_game(self.game), 0)
+        self.assertEqual(redis_state.called_sequence(self.game.id), bytes([5, 9]))
+
+    def test_called_sequence_of_missing_game(self):
+        self.assertIsNone(redis_state.called_sequence(self.game.id))
+
+    def test_call_next_loads_missing_game(self):
+        number, cursor, sequence = redis_state.call_next(self.game)
+        self.assertEqual((number, cursor, sequence), (self.order[0], 1, bytes([self.order[0]])))
+
+    def test_call_next_skips_numbers_called_by_hand(self):
+        self.set_called([self.order[0], self.order[1]])
+        number, cursor, sequence = redis_state.call_next(self.game)
+        self.assertEqual(number, self.order[2])
+        self.assertEqual(cursor, 3)
+        self.assertEqual(sequence, bytes(self.order[:3]))
+
+    def test_call_next_exhausted(self):
+        self.set_called(self.order[:-1])
+        number, cursor, sequence = redis_state.call_next(self.game)
+        self.assertEqual(number, self.order[-1])
+        self.assertEqual(len(sequence), len(self.order))
+        self.assertEqual(redis_state.call_next(self.game), (None, len(self.order), bytes(self.order)))
+
+    def test_call_next_many_mixes_loaded_and_missing_games(self):
+        other = Game.objects.create(
+            name='Otra', organizer=self.game.organizer, base_prize=100, is_started=True, draw_seed=99,
+        )
+        self.addCleanup(redis_state.discard_game_state, other.id)
+        redis_state.discard_game_state(other.id)
+        redis_state.load_game(self.game)
+
+        draws = redis_state.call_next_many([self.game, other])
+        self.assertEqual(draws[0], (self.order[0], 1, bytes([self.order[0]])))
+        other_first = draw_order(other.draw_seed)[0]
+        self.assertEqual(draws[1], (other_first, 1, bytes([other_first])))
+
+    def test_manual_call(self):
+        self.assertEqual(redis_state.call_manual(self.game, 42), (42, bytes([42])))
+        # Repetido: no se añade
+        self.assertEqual(redis_state.call_manual(self.game, 42), (None, bytes([42])))
+
+        # La extracción automática salta el número llamado a mano
+        number, _, sequence = redis_state.call_next(self.game)
+        self.assertNotEqual(number, 42)
+        self.assertEqual(sequence, bytes([42, number]))
+
+    def test_manual_call_reloads_expired_game(self):
+        self.set_called([3])
+        redis_state.call_manual(self.game, 4)
+        redis_state.discard_game_state(self.game.id)
+        # El script devuelve -1, se recarga desde el Game y se reintenta
+        self.set_called([3, 4])
+        self.assertEqual(redis_state.call_manual(self.game, 5), (5, bytes([3, 4, 5])))
+
+    def test_add_cards_sold(self):
+        self.game.total_cards_sold = 2
+        self.game.max_cards_sold = 5
+        self.assertEqual(redis_state.add_cards_sold(self.game), (3, 5))
+        self.assertEqual(redis_state.add_cards_sold(self.game, 4), (7, 7))
+        self.assertEqual(redis_state.add_cards_sold(self.game, -2), (5, 7))
+
+    def test_call_next_requires_lease_token(self):
+        client = redis_state.get_redis()
+        lease = redis_state.lease_key(self.game.id)
+        self.addCleanup(client.delete, lease)
+        client.set(lease, 'worker-a')
+
+        self.assertEqual(redis_state.call_next(self.game, 'worker-a')[0], self.order[0])
+        # Otro worker (o uno cuya concesión caducó) no extrae ni mueve el cursor
+        self.assertIsNone(redis_state.call_next(self.game, 'worker-b'))
+        self.assertEqual(redis_state.call_next_many([self.game], 'worker-b'), [None])
+        client.delete(lease)
+        self.assertIsNone(redis_state.call_next(self.game, 'worker-a'))
+        self.assertEqual(redis_state.called_sequence(self.game.id), bytes([self.order[0]]))
+
+
+class GameFormStageTests(TestCase):
+
+    def form(self, prize_stages_json):
+        return GameForm(data={
+            'name': 'Partida', 'card_price': '1', 'max_cards_per_player': '5', 'winning_pattern': 'FULL',
+            'base_prize': '10', 'auto_call_interval': '5', 'prize_stages_json': prize_stages_json,
+        })
+
+    def test_valid_stages(self):
+        form = self.form('[{"pattern": "HORIZONTAL", "lines": 2, "percentage": 10}]')
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['prize_stages'], [{'pattern': 'HORIZONTAL', 'lines': 2, 'percentage': 10.0}])
+
+    def test_rejects_malformed_stages(self):
+        for data in ('{"pattern": "HORIZONTAL"}', '[1]', '"x"', 'no es json'):
+            with self.subTest(data=data):
+                self.assertFalse(self.form(data).is_valid())
+
+    def test_rejects_more_lines_than_the_pattern_has(self):
+        for pattern, lines in (('CORNERS', 3), ('HORIZONTAL', 6), ('DIAGONAL', 3)):
+            with self.subTest(pattern=pattern):
+                data = f'[{{"pattern": "{pattern}", "lines": {lines}, "percentage": 10}}]'
+                self.assertFalse(self.form(data).is_valid())
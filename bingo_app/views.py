@@ -11,7 +11,7 @@ from django.http import JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, authenticate
-from django.db.models import Sum, Q
+from django.db.models import Count, Sum, Q
 from django.db import transaction
 from django.views.decorators.http import require_http_methods
 from django.contrib import messages
@@ -19,6 +19,11 @@ from django.contrib.admin.views.decorators import staff_member_required
 from asgiref.sync import async_to_sync  # Necesario para llamadas síncronas a Channels
 from channels.layers import get_channel_layer  # Para enviar mensajes via WebSocket
 from .flash_messages import add_flash_message
+from . import event_log, redis_state
+from .broadcast import group_send_sync, number_called_event
+from .game_state import game_states
+from .scheduler import notify_scheduler
+from .winners import resolve_stages
 
 
 from .forms import PercentageSettingsForm, RegistrationForm, GameForm, BuyTicketForm, RaffleForm, CreditRequestForm, WithdrawalRequestForm,PaymentMethodForm
@@ -103,6 +108,9 @@ def create_game(request):
                     game.current_prize = base_prize  # Establecer premio inicial
                     game.save()
 
+                    # Pre-generar el pool de cartones únicos antes de abrir la venta
+                    game.generate_card_pool()
+
                     # Manejar patrón personalizado
                     if game.winning_pattern == 'CUSTOM':
                         if 'pattern_file' in request.FILES:
@@ -179,17 +187,15 @@ def game_room(request, game_id):
 
     # Handle card purchases
     if request.method == 'POST' and 'buy_card' in request.POST and not game.is_started:
-        if len(player.cards) >= game.max_cards_per_player:
+        if player.card_count >= game.max_cards_per_player:
             messages.error(request, 'Has alcanzado el límite de cartones')
         elif request.user.credit_balance < game.card_price:
             messages.error(request, f'Saldo insuficiente. Necesitas {game.card_price} créditos')
         else:
             try:
                 with transaction.atomic():
-                    # Generate new card
-                    new_card = generate_bingo_card()
-                    player.cards.append(new_card)
-                    player.save()
+                    # Take a pre-generated card from the game's pool
+                    player.take_card_from_pool()
                     
                     # Charge for card
                     request.user.credit_balance -= game.card_price
@@ -208,8 +214,7 @@ def game_room(request, game_id):
                     distribute_purchase(game, game.card_price, percentage_settings)
                     
                     # Update game stats
-                    game.total_cards_sold += 1
-                    game.save()
+                    add_cards_sold(game)
                     
                     # Check for progressive prize
                     check_progressive_prize(game)
@@ -275,13 +280,26 @@ def game_room(request, game_id):
             messages.error(request, 'No has completado el patrón ganador')
 
     chat_messages = ChatMessage.objects.filter(game=game).order_by('-timestamp')[:50]
+    players = game.player_set.select_related('user').annotate(num_cards=Count('bingo_cards'))
     
     return render(request, 'bingo_app/game_room.html', {
         'game': game,
         'player': player,
+        'players': players,
         'chat_messages': chat_messages,
     })
 
+def add_cards_sold(game, count=1):
+    """Suma cartones vendidos; con Redis el contador es atómico entre workers"""
+    if redis_state.enabled():
+        game.total_cards_sold, game.max_cards_sold = redis_state.add_cards_sold(game, count)
+    else:
+        game.total_cards_sold += count
+    game.save()
+    if redis_state.enabled():
+        redis_state.set_prize(game.id, game.current_prize)
+
+
 def distribute_purchase(game, amount, percentage_settings):
     """Distribute card purchase according to percentages"""
     admin_share = amount * (percentage_settings.admin_percentage / 100)
@@ -366,41 +384,13 @@ def distribute_remaining_funds(game, percentage_settings):
         )
 
 
-def generate_bingo_card():
-    """Genera un cartón de Bingo tradicional 5x5 con letras B-I-N-G-O y comodín central"""
-    # Rangos para cada columna según las letras B-I-N-G-O
-    ranges = {
-        'B': (1, 15),
-        'I': (16, 30),
-        'N': (31, 45),
-        'G': (46, 60),
-        'O': (61, 75)
-    }
-    
-    card = []
-    for letter in ['B', 'I', 'N', 'G', 'O']:
-        # Generar 5 números únicos para cada columna
-        start, end = ranges[letter]
-        numbers = random.sample(range(start, end+1), 5)
-        
-        # Para la columna N (tercera columna), el tercer número es comodín (0 o vacío)
-        if letter == 'N':
-            numbers[2] = 0  # O usar "" para representar el comodín
-        
-        card.append(numbers)
-    
-    # Transponer la matriz para tener filas en lugar de columnas
-    card_rows = list(zip(*card))
-    
-    return list(card_rows)
-
 @login_required
 def profile(request):
     won_raffles = Raffle.objects.filter(winner=request.user)  # ← Nuevo
     return render(request, 'bingo_app/profile.html', {
         'user': request.user,
         'games_created': request.user.organized_games.all(),
-        'games_playing': request.user.player_set.all(),
+        'games_playing': request.user.player_set.select_related('game__organizer', 'game__winner').prefetch_related('bingo_cards'),
         'won_games': Game.objects.filter(winner=request.user),
         'won_raffles': won_raffles,  # ← Añadido al contexto
 
@@ -479,7 +469,8 @@ def buy_card(request, game_id):
             'error': 'No se pueden comprar cartones después de que el juego ha comenzado'
         }, status=400)
     
-    if len(player.cards) >= game.max_cards_per_player:
+    player_cards_count = player.card_count
+    if player_cards_count >= game.max_cards_per_player:
         return JsonResponse({
             'success': False, 
             'error': 'Has alcanzado el límite de cartones para esta partida'
@@ -493,10 +484,9 @@ def buy_card(request, game_id):
     
     try:
         with transaction.atomic():
-            # Generar nuevo cartón
-            new_card = generate_bingo_card()
-            player.cards.append(new_card)
-            player.save()
+            # Tomar un cartón del pool pre-generado de la partida
+            new_card = player.take_card_from_pool().matrix
+            player_cards_count += 1
             
             # Descontar créditos
             request.user.credit_balance -= game.card_price
@@ -512,8 +502,7 @@ def buy_card(request, game_id):
             )
             
             # Actualizar estadísticas del juego
-            game.total_cards_sold += 1
-            game.save()
+            add_cards_sold(game)
             
             # Verificar premio progresivo
             prize_increase = game.check_progressive_prize()
@@ -521,7 +510,7 @@ def buy_card(request, game_id):
             response_data = {
                 'success': True,
                 'new_balance': float(request.user.credit_balance),
-                'player_cards_count': len(player.cards),
+                'player_cards_count': player_cards_count,
                 'new_card': new_card,  # Enviar el cartón en la respuesta
                 'prize_increased': prize_increase > 0,
                 'new_prize': float(game.current_prize),
@@ -531,26 +520,24 @@ def buy_card(request, game_id):
                 'progress_percentage': game.progress_percentage
             }
             
-            # Modificar el mensaje WebSocket para que NO incluya el cartón para el usuario actual
-            from channels.layers import get_channel_layer
-            from asgiref.sync import async_to_sync
-            
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
+            # A todo el grupo solo los totales; el cartón y el saldo van al comprador
+            group_send_sync(
                 f'game_{game.id}',
-                {
-                    'type': 'card_purchased',
-                    'user': request.user.username,
-                    'new_balance': float(request.user.credit_balance),
-                    'player_cards_count': len(player.cards),
-                    'new_card':  new_card,  # No enviar cartón al propio usuario
-                    'prize_increased': prize_increase > 0,
-                    'new_prize': float(game.current_prize),
-                    'increase_amount': float(prize_increase) if prize_increase > 0 else 0,
-                    'total_cards_sold': game.total_cards_sold,
-                    'next_prize_target': game.next_prize_target,
-                    'progress_percentage': game.progress_percentage
-                }
+                'card_purchased',
+                prize_increased=prize_increase > 0,
+                new_prize=float(game.current_prize),
+                increase_amount=float(prize_increase) if prize_increase > 0 else 0,
+                total_cards_sold=game.total_cards_sold,
+                max_cards_sold=game.max_cards_sold,
+                next_prize_target=game.next_prize_target,
+                progress_percentage=game.progress_percentage
+            )
+            group_send_sync(
+                f'game_{game.id}_user_{request.user.id}',
+                'own_card_purchased',
+                new_balance=float(request.user.credit_balance),
+                player_cards_count=player_cards_count,
+                new_card=new_card
             )
             
             return JsonResponse(response_data)
@@ -685,6 +672,7 @@ def toggle_auto_call(request, game_id):
     
     if game.is_auto_calling:
         game.stop_auto_calling()
+        async_to_sync(notify_scheduler)(game.id)
         return JsonResponse({
             'success': True, 
             'is_auto_calling': False, 
@@ -692,6 +680,7 @@ def toggle_auto_call(request, game_id):
         })
     else:
         game.start_auto_calling()
+        async_to_sync(notify_scheduler)(game.id)
         return JsonResponse({
             'success': True, 
             'is_auto_calling': True, 
@@ -1406,32 +1395,30 @@ def call_number(request, game_id):
         if number < 1 or number > 76:
             return JsonResponse({'success': False, 'error': 'Número fuera de rango'}, status=400)
             
-        if number in game.called_numbers:
-            return JsonResponse({'success': False, 'error': 'Número ya llamado'}, status=400)
-            
-        game.current_number = number
-        game.called_numbers.append(number)
-        game.save()
+        if redis_state.enabled():
+            # Marcar en Redis de forma atómica y guardar la secuencia compartida
+            called, sequence = redis_state.call_manual(game, number)
+            if called is None:
+                return JsonResponse({'success': False, 'error': 'Número ya llamado'}, status=400)
+            game.save(update_fields=game.apply_called_sequence(sequence))
+        else:
+            # Sin Redis la fila es la secuencia compartida: el planificador extrae con ella bloqueada
+            with transaction.atomic():
+                game = Game.objects.select_for_update().get(id=game.id)
+                if game.is_called(number):
+                    return JsonResponse({'success': False, 'error': 'Número ya llamado'}, status=400)
+
+                game.register_called_number(number)
+            # Si el planificador corre en este proceso, que su estado no vaya por detrás
+            game_states.merge_persisted({game.id: game.called_sequence})
         
         # Verificar si hay ganadores
-        winners = []
-        for player in game.player_set.all():
-            if player.check_bingo():
-                winners.append(player.user)
+        winners = [player.user for player in resolve_stages(game)]
         
-        # Notificar via WebSocket
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f'game_{game.id}',
-            {
-                'type': 'number_called',
-                'number': number,
-                'called_numbers': game.called_numbers,
-                'is_manual': True,
-                'has_winner': len(winners) > 0,
-                'winners': [winner.username for winner in winners] if winners else None
-            }
-        )
+        # Notificar via WebSocket y guardar el evento para reanudar conexiones
+        event = number_called_event(number, game.called_count)
+        event_log.record(game.id, game.called_count, event['text'])
+        async_to_sync(get_channel_layer().group_send)(f'game_{game.id}', event)
         
         # Si hay ganadores, finalizar el juego
         if winners:
@@ -0,0 +1,103 @@
+"""
+Detección de ganadores por partida usando los motores de engine.py.
+
+El índice de cada partida se construye una vez por proceso y luego solo se
+actualiza con los números nuevos, en lugar de recorrer todos los jugadores y
+cartones después de cada bola. Las partidas con al menos
+BINGO_NUMPY_WINNER_THRESHOLD cartones se evalúan con numpy en una sola pasada. Las etapas de premio
+intermedias (Game.prize_stages) se evalúan en la misma pasada que la final.
+"""
+import threading
+
+from django.conf import settings
+
+from .engine import GameCardArray, GameCardIndex, game_stages
+from .models import Card, Player
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _index_version(game):
+    return (game_stages(game), game.total_cards_sold)
+
+
+def uses_numpy_engine(game):
+    threshold = getattr(settings, 'BINGO_NUMPY_WINNER_THRESHOLD', 5000)
+    return threshold is not None and game.total_cards_sold >= threshold
+
+
+def build_game_index(game):
+    engine_class = GameCardArray if uses_numpy_engine(game) else GameCardIndex
+    index = engine_class(game_stages(game))
+    cards = Card.objects.filter(game_id=game.id, player__isnull=False).values_list('player_id', 'id', 'numbers')
+    for player_id, card_id, numbers in cards.iterator(chunk_size=5000):
+        index.add_card(player_id, card_id, numbers)
+    return index
+
+
+def get_game_index(game):
+    """Devuelve el índice de la partida, reconstruyéndolo si cambió su configuración"""
+    version = _index_version(game)
+    with _indexes_lock:
+        cached = _indexes.get(game.id)
+    if cached is not None and cached[0] == version:
+        index = cached[1]
+        # Si el índice tiene números que la partida ya no tiene, está desfasado
+        if index.applied_mask & ~game.called_mask_int == 0:
+            return index
+
+    index = build_game_index(game)
+    with _indexes_lock:
+        _indexes[game.id] = (version, index)
+    return index
+
+
+def discard_game_index(game_id):
+    with _indexes_lock:
+        _indexes.pop(game_id, None)
+
+
+def find_stage_winner_ids(game):
+    """Tupla con los player_id que han completado cada etapa (la última es la final)"""
+    return get_game_index(game).sync(game.called_numbers)
+
+
+def find_winner_ids(game):
+    """player_id de los jugadores que han completado la etapa en juego"""
+    stage_winners = find_stage_winner_ids(game)
+    return stage_winners[min(game.current_stage, len(stage_winners) - 1)]
+
+
+def _load_players(player_ids):
+    if not player_ids:
+        return []
+    return list(Player.objects.filter(id__in=player_ids).select_related('user').order_by('id'))
+
+
+def find_winners(game):
+    """Jugadores (con su usuario precargado) que han completado la etapa en juego"""
+    return _load_players(find_winner_ids(game))
+
+
+def resolve_stages(game):
+    """
+    Paga las etapas intermedias completadas, en orden, y devuelve los
+    jugadores que completaron la etapa final (lista vacía si la partida sigue).
+    La etapa final se resuelve aunque alguna intermedia se haya quedado sin
+    ganador: esas etapas no se pagan y su parte pasa al premio final.
+    """
+    stage_winners = find_stage_winner_ids(game)
+    final_stage = len(stage_winners) - 1
+    while game.current_stage < final_stage:
+        players = _load_players(stage_winners[game.current_stage])
+        if not players:
+            break
+        game.award_stage(game.current_stage, [player.user for player in players])
+    return _load_players(stage_winners[final_stage])
+
+
+def has_pending_winners(game, stage_winners):
+    """True si resolve_stages pagaría algo con estos ganadores por etapa"""
+    return bool(stage_winners[min(game.current_stage, len(stage_winners) - 1)] or stage_winners[-1])
@@ -10,6 +10,8 @@ django.setup()  # Esto es crucial
 
 # Ahora importa tus rutas y consumers
 import bingo_app.routing
+from django.conf import settings
+from bingo_app.scheduler import SchedulerStartupMiddleware
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
@@ -18,4 +20,8 @@ application = ProtocolTypeRouter({
             bingo_app.routing.websocket_urlpatterns
         )
     ),
-})
\ No newline at end of file
+})
+
+if settings.BINGO_SCHEDULER_EMBEDDED:
+    # Retomar las partidas con llamada automática en cuanto arranca el servidor
+    application = SchedulerStartupMiddleware(application)
@@ -0,0 +1,25 @@
+"""
+Arranca la aplicación ASGI con uvicorn y compresión permessage-deflate.
+
+    python -m bingo_project.serve
+
+Escucha en HOST:PORT (0.0.0.0:8000 por defecto). Ver bingo_project/websocket.py.
+"""
+import os
+
+import uvicorn
+
+from .websocket import CompressedWebSocketProtocol
+
+
+def main():
+    uvicorn.run(
+        'bingo_project.asgi:application',
+        host=os.environ.get('HOST', '0.0.0.0'),
+        port=int(os.environ.get('PORT', 8000)),
+        ws=CompressedWebSocketProtocol,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -162,6 +162,58 @@ STATICFILES_DIRS = [
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')  # carpeta donde Django los recolectará para producción
 
+# Motor de detección de ganadores: las partidas con al menos este número de
+# cartones se evalúan con numpy (None desactiva el modo vectorizado)
+BINGO_NUMPY_WINNER_THRESHOLD = int(os.environ.get("BINGO_NUMPY_WINNER_THRESHOLD", 5000))
+
+# Cartones únicos pre-generados por partida (y tamaño de cada recarga del pool)
+BINGO_CARD_POOL_SIZE = int(os.environ.get("BINGO_CARD_POOL_SIZE", 500))
+
+# Planificador de llamadas automáticas: con EMBEDDED corre dentro del servidor
+# ASGI; en producción se desactiva y se usa el worker run_game_scheduler
+BINGO_SCHEDULER_EMBEDDED = os.environ.get("BINGO_SCHEDULER_EMBEDDED", "True") == "True"
+BINGO_SCHEDULER_RECONCILE_INTERVAL = float(os.environ.get("BINGO_SCHEDULER_RECONCILE_INTERVAL", 5))
+# Segundos de retraso de un tick a partir de los cuales se registra un aviso
+BINGO_SCHEDULER_DRIFT_WARNING = float(os.environ.get("BINGO_SCHEDULER_DRIFT_WARNING", 1.0))
+
+# Estado en memoria de las partidas en curso: con BINGO_REDIS_STATE, segundos
+# máximos antes de guardar las bolas en la base de datos y partidas pendientes
+# que fuerzan la escritura (sin Redis cada bola se guarda al extraerla)
+BINGO_STATE_FLUSH_INTERVAL = float(os.environ.get("BINGO_STATE_FLUSH_INTERVAL", 1.0))
+BINGO_STATE_FLUSH_BATCH = int(os.environ.get("BINGO_STATE_FLUSH_BATCH", 500))
+
+# Estado compartido de las partidas en Redis (números llamados, cursor, cartones
+# vendidos y premio), actualizado con scripts Lua atómicos
+BINGO_REDIS_STATE = os.environ.get("BINGO_REDIS_STATE", "True") == "True"
+BINGO_REDIS_URL = redis_url or "redis://localhost:6379/0"
+BINGO_REDIS_STATE_TTL = int(os.environ.get("BINGO_REDIS_STATE_TTL", 86400))
+
+# Concesión por partida entre workers del planificador: caduca a los TTL_MS
+# milisegundos sin renovar y se renueva cada HEARTBEAT segundos
+BINGO_LEASE_TTL_MS = int(os.environ.get("BINGO_LEASE_TTL_MS", 2000))
+BINGO_LEASE_HEARTBEAT = float(os.environ.get("BINGO_LEASE_HEARTBEAT", 0.5))
+
+# Segundos máximos para recuperar las partidas activas al arrancar el planificador
+BINGO_RECOVERY_BUDGET = float(os.environ.get("BINGO_RECOVERY_BUDGET", 10.0))
+
+# number_called recientes por partida que se guardan para reanudar conexiones
+BINGO_EVENT_BUFFER_SIZE = int(os.environ.get("BINGO_EVENT_BUFFER_SIZE", 30))
+
+# Chat de las salas: segundos que se acumulan los mensajes antes de guardarlos
+# y difundirlos juntos, y límite por usuario (mensajes/segundo y ráfaga)
+BINGO_CHAT_BATCH_INTERVAL = float(os.environ.get("BINGO_CHAT_BATCH_INTERVAL", 0.1))
+BINGO_CHAT_RATE = float(os.environ.get("BINGO_CHAT_RATE", 1.0))
+BINGO_CHAT_BURST = int(os.environ.get("BINGO_CHAT_BURST", 5))
+
+# Compresión permessage-deflate (servidor de bingo_project.serve): solo se
+# comprimen los mensajes de al menos MIN_SIZE bytes
+BINGO_WS_COMPRESSION = os.environ.get("BINGO_WS_COMPRESSION", "True") == "True"
+BINGO_WS_COMPRESSION_MIN_SIZE = int(os.environ.get("BINGO_WS_COMPRESSION_MIN_SIZE", 32))
+
+# Mensajes pendientes por conexión (tras fusionar los superados) a partir de
+# los cuales un cliente lento se desconecta para que reanude
+BINGO_WS_OUTBOX_SIZE = int(os.environ.get("BINGO_WS_OUTBOX_SIZE", 64))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
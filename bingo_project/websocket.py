@@ -0,0 +1,76 @@
+"""
+Compresión permessage-deflate para los WebSockets servidos con uvicorn.
+
+ThresholdPerMessageDeflate solo comprime los mensajes de al menos
+BINGO_WS_COMPRESSION_MIN_SIZE bytes; los más pequeños (como las tramas
+binarias de number_called) se envían sin comprimir, con RSV1 desactivado,
+como permite el RFC 7692. El contexto de compresión se conserva entre mensajes y la ventana
+y la memoria de zlib se limitan como en la configuración por defecto de
+websockets, para que miles de sockets no multipliquen el consumo de memoria.
+
+Se usa con `python -m bingo_project.serve`, que arranca uvicorn con
+CompressedWebSocketProtocol. El navegador negocia la extensión por sí solo;
+los clientes que no la ofrecen reciben los mensajes sin comprimir.
+`manage.py benchmark_ws_compression` mide el efecto de cada umbral.
+"""
+from django.conf import settings
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, OP_CONT
+
+
+MAX_WINDOW_BITS = 12
+COMPRESS_SETTINGS = {'memLevel': 5}
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate que deja sin comprimir los mensajes pequeños"""
+
+    def __init__(self, *args, min_size=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.skip_message = False
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode is not OP_CONT:
+            self.skip_message = len(frame.data) < self.min_size
+        if self.skip_message:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, min_size=0):
+        super().__init__(
+            server_max_window_bits=MAX_WINDOW_BITS,
+            client_max_window_bits=MAX_WINDOW_BITS,
+            compress_settings=COMPRESS_SETTINGS,
+        )
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+        )
+
+
+class CompressedWebSocketProtocol(WebSocketProtocol):
+    """Protocolo WebSocket de uvicorn con permessage-deflate por umbral"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # uvicorn ya cargó la aplicación (y con ella los settings de Django)
+        if getattr(settings, 'BINGO_WS_COMPRESSION', True):
+            min_size = getattr(settings, 'BINGO_WS_COMPRESSION_MIN_SIZE', 32)
+            self.available_extensions = [ThresholdPerMessageDeflateFactory(min_size)]
+        else:
+            self.available_extensions = []